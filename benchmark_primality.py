@@ -0,0 +1,42 @@
+import random, time
+
+from functions.generate_prime_number import isPrime, generatePrimeNumberWithSieve
+
+# Compare the Rabin Miller test (k=5) with the Baillie-PSW test on 1024-bit candidates:
+# random odd numbers (mostly composites, as seen by a naive prime search) and primes (the accepted candidates).
+PRIME_LENGTH = 1024
+CANDIDATES = 500
+PRIMES = 20
+
+def time_test(numbers, test):
+    """
+    Time a primality test on a list of numbers.
+
+    Args:
+        numbers (list): The integers to test.
+        test (str): The primality test given to isPrime, "rabin_miller" or "baillie_psw".
+
+    Returns:
+        tuple: A tuple containing:
+            - float: The total time in seconds.
+            - list: The verdict for each number.
+    """
+    start = time.perf_counter()
+    verdicts = [isPrime(number, test=test) for number in numbers]
+    return time.perf_counter() - start, verdicts
+
+def main():
+    rng = random.Random("benchmark")
+    candidates = [rng.getrandbits(PRIME_LENGTH) | (1 << (PRIME_LENGTH - 1)) | 1 for _ in range(CANDIDATES)]
+    primes = [generatePrimeNumberWithSieve(PRIME_LENGTH, seed=f"benchmark{i}") for i in range(PRIMES)]
+
+    for label, numbers in (("random odd candidates", candidates), ("primes", primes)):
+        print(f"{len(numbers)} {PRIME_LENGTH}-bit {label}:")
+        rabin_miller_time, rabin_miller_verdicts = time_test(numbers, "rabin_miller")
+        baillie_psw_time, baillie_psw_verdicts = time_test(numbers, "baillie_psw")
+        print(f"    rabin_miller (k=5) : {rabin_miller_time:8.3f} s  ({1000 * rabin_miller_time / len(numbers):.2f} ms per number)")
+        print(f"    baillie_psw        : {baillie_psw_time:8.3f} s  ({1000 * baillie_psw_time / len(numbers):.2f} ms per number)")
+        print(f"    same verdicts      : {rabin_miller_verdicts == baillie_psw_verdicts}")
+
+if __name__ == "__main__":
+    main()
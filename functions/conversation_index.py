@@ -0,0 +1,201 @@
+import json, os, threading
+
+from functions.file_lock import file_lock, atomic_write
+from functions.message_log import MESSAGE_LOG_DIRECTORY, read_messages_since
+from functions.user_directory import encode_username
+
+# Each user has an index of their conversations, kept next to the message log:
+# {"next_id": int, "deleted": int, "conversations": {partner: {"partner": str, "last_message_id": int, "last_timestamp": str, "message_count": int}},
+#  "groups": {name: {"group": str, "last_message_id": int, "last_timestamp": str, "message_count": int}}}
+# "next_id" and "deleted" tell which state of the log the index describes.
+INDEX_DIRECTORY = 'index'
+# Held while indexes are updated, by the threads of a process and by the other processes using the same directory
+INDEX_LOCK_FILENAME = 'index.lock'
+
+index_lock = threading.RLock()
+
+def get_index_path(user, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the path of the conversation index of a user, named after the encoded username (see encode_username).
+
+    Args:
+        user (str): The username.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        str: The path of the index.
+    """
+    return os.path.join(directory, INDEX_DIRECTORY, f"{encode_username(user)}.json")
+
+def lock_conversation_indexes(directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the lock of the conversation indexes, held while they are updated (see file_lock).
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        contextmanager: The lock, to use in a with statement.
+    """
+    os.makedirs(os.path.join(directory, INDEX_DIRECTORY), exist_ok=True)
+    return file_lock(os.path.join(directory, INDEX_DIRECTORY, INDEX_LOCK_FILENAME), index_lock)
+
+def create_conversation_index():
+    """
+    Give an empty conversation index, describing an empty log.
+
+    Returns:
+        dict: The index.
+    """
+    return {"next_id": 1, "deleted": 0, "conversations": {}, "groups": {}}
+
+def load_conversation_index(user, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Load the conversation index of a user as it is on disk (it may be behind the log, see refresh_conversation_index).
+
+    Args:
+        user (str): The username.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        dict: The index, empty if the user has none or if it cannot be read.
+    """
+    try:
+        with open(get_index_path(user, directory), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return create_conversation_index()
+
+def write_conversation_index(user, index, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Write the conversation index of a user, replacing the previous one in one step.
+
+    Args:
+        user (str): The username.
+        index (dict): The index.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.join(directory, INDEX_DIRECTORY), exist_ok=True)
+    # Not synced to the disk: an index lost or damaged by a crash is read as empty and rebuilt from the log
+    atomic_write(get_index_path(user, directory), json.dumps(index), fsync=False)
+
+def get_message_readers(message):
+    """
+    Give the users who can read a message: its sender and recipient, or the members of its group.
+
+    Args:
+        message (dict): The message.
+
+    Returns:
+        set: The usernames of the readers.
+    """
+    if message.get('group') is not None:
+        return set(message['wrapped_keys'])
+    return {message['sender'], message['recipient']}
+
+def add_message_to_index(index, user, message):
+    """
+    Count a message in the conversation index of one of its readers.
+
+    Args:
+        index (dict): The index of the user.
+        user (str): The username.
+        message (dict): The message.
+
+    Returns:
+        None
+    """
+    if message.get('group') is not None:
+        summary = index.setdefault('groups', {}).setdefault(message['group'], {
+            "group": message['group'],
+            "last_message_id": 0,
+            "last_timestamp": None,
+            "message_count": 0
+        })
+    else:
+        partner = message['recipient'] if message['sender'] == user else message['sender']
+        if partner == user:
+            return
+
+        summary = index['conversations'].setdefault(partner, {
+            "partner": partner,
+            "last_message_id": 0,
+            "last_timestamp": None,
+            "message_count": 0
+        })
+    summary['message_count'] += 1
+    if message['id'] > summary['last_message_id']:
+        summary['last_message_id'] = message['id']
+        summary['last_timestamp'] = message['timestamp']
+
+def refresh_conversation_index(user, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Bring the conversation index of a user up to date with the log: the messages written since the index was
+    last updated are added to it, and it is rebuilt if messages have been deleted since.
+
+    Args:
+        user (str): The username.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        dict: The up to date index.
+    """
+    with lock_conversation_indexes(directory):
+        index = load_conversation_index(user, directory)
+        reset, messages, state = read_messages_since(index['next_id'], index['deleted'], directory)
+
+        if state == {"next_id": index['next_id'], "deleted": index['deleted']}:
+            return index
+
+        if reset:
+            index = create_conversation_index()
+
+        for message in messages:
+            if user in get_message_readers(message):
+                add_message_to_index(index, user, message)
+
+        index.update(state)
+        write_conversation_index(user, index, directory)
+        return index
+
+def index_message(message, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Add a message that has just been appended to the log to the conversation index of its readers.
+
+    Args:
+        message (dict): The stored message, with its id.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    with lock_conversation_indexes(directory):
+        for user in get_message_readers(message):
+            index = load_conversation_index(user, directory)
+            if index['next_id'] == message['id']:
+                add_message_to_index(index, user, message)
+                index['next_id'] = message['id'] + 1
+                write_conversation_index(user, index, directory)
+            else:
+                # The index is behind the log (other messages, or a crash before it was written): catch up from the log
+                refresh_conversation_index(user, directory)
+
+def get_conversation_summaries(user, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the summaries of the conversations of a user (with other users and in groups), most recent activity first,
+    without reading any message.
+
+    Args:
+        user (str): The username.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        list: The summaries {"partner": str, "last_message_id": int, "last_timestamp": str, "message_count": int},
+            with "group" (the name of the group) instead of "partner" for a group conversation.
+    """
+    index = refresh_conversation_index(user, directory)
+    summaries = list(index['conversations'].values()) + list(index.get('groups', {}).values())
+    return sorted(summaries, key=lambda summary: summary['last_message_id'], reverse=True)
@@ -1,55 +1,92 @@
-import json
-from functions.user_management import get_public_key_from_user
-from functions.rsa_management import cipher_with_rsa
+from functions.message_log import MESSAGE_LOG_DIRECTORY, load_messages, append_message, iter_messages_newest_first
+from functions.conversation_index import index_message, get_message_readers, get_conversation_summaries
+from functions.group_management import find_group, get_groups_of_user, create_group
+from functions.plaintext_cache import get_cached_plaintext, cache_plaintext
+from functions.user_management import get_public_key_from_user, get_key_version_from_user
+from functions.rsa_management import cipher_bytes_with_rsa, decipher_bytes_with_rsa, decipher_with_rsa, encode_blocks, decode_blocks, get_block_size
+from functions.stream_cipher import generate_session_key, cipher_with_stream, decipher_with_stream
+from functions.key_agent_client import is_agent_key
+from functions.message_server_client import send_server_request
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from itertools import islice, repeat
+import os, threading
 
-def load_all_conversations(filename='data/conversations.json'):
+# Number of messages shown when a conversation is opened, and loaded each time older messages are asked for
+CONVERSATION_PAGE_SIZE = 20
+
+# A full page of messages not read yet (opening a conversation, loading older messages) is decrypted in worker processes,
+# if the machine has more than one CPU. Fewer messages (a conversation that has just been sent a message) are decrypted
+# in the program, where sending them to the workers is expected to cost more than it saves.
+# This threshold is a guess: it has not been measured on a machine with several CPUs.
+PARALLEL_DECRYPTION_MIN_MESSAGES = CONVERSATION_PAGE_SIZE
+
+# Private key of the reader in a decryption worker process, sent once when the worker starts
+worker_private_key = None
+
+# Worker processes of the session, started the first time they are needed and kept until logout (see shutdown_decryption_pool):
+# {"executor": ProcessPoolExecutor, "user": str, "key": tuple}
+decryption_pool = {"executor": None, "user": None, "key": None}
+decryption_pool_lock = threading.Lock()
+
+def load_all_conversations(directory=MESSAGE_LOG_DIRECTORY):
     """
-    Load all conversations from a JSON file.
+    Load all conversations from the message log.
 
     Args:
-        filename (str): The path to the JSON file where conversations are stored. Defaults to 'data/conversations.json'.
+        directory (str): The directory of the message log. Defaults to 'data/messages'.
 
     Returns:
-        list: A list of conversations loaded from the JSON file. If the file does not exist, returns an empty list.
+        list: A list of messages loaded from the message log. If the log does not exist yet, it is created (and the messages of 'data/conversations.json' are imported).
     """
-    try:
-        with open(filename, 'r') as file:
-            conversations = json.load(file)
-    except FileNotFoundError:
-        conversations = []
-    return conversations
+    return load_messages(directory)
     
-def load_conversations_from_user(user, filename='data/conversations.json'):
+def load_conversations_from_user(user, directory=MESSAGE_LOG_DIRECTORY):
     """
-    Load and organize conversations for a specific user from a JSON file.
+    Load and organize conversations for a specific user from the message log.
 
     Args:
         user (str): The username of the user whose conversations are to be loaded.
-        filename (str): The path to the JSON file where conversations are stored. Defaults to 'data/conversations.json'.
+        directory (str): The directory of the message log. Defaults to 'data/messages'.
 
     Returns:
-        dict: A dictionary containing organized conversations for the specified user. The dictionary has two keys:
+        dict: A dictionary containing organized conversations for the specified user. The dictionary has four keys:
             - "users_interactions": A list of usernames with whom the user has conversations.
             - "conversations": A list of dictionaries, each representing a conversation with a specific user. Each conversation dictionary contains:
                 - "conversation_with": The username of the other participant in the conversation.
                 - "messages": A list of messages exchanged with that user.
+            - "groups_interactions": A list of the names of the groups in which the user has received or sent messages.
+            - "group_conversations": A list of dictionaries {"group": str, "messages": list}, one per group.
     """
 
-    conversations = load_all_conversations(filename)
-    
+    # The log is read newest first, and only the messages the user can read are kept
     user_conversations = [
-        message for message in conversations
-        if message['sender'] == user or message['recipient'] == user
+        message for message in iter_messages_newest_first(directory)
+        if user in get_message_readers(message)
     ]
+    user_conversations.reverse()
 
     user_conversations_sorted = {
         "users_interactions" : [],
-        "conversations" : []
+        "conversations" : [],
+        "groups_interactions" : [],
+        "group_conversations" : []
     }
 
     for message in user_conversations:
 
+        if message.get('group') is not None:
+            group = message['group']
+            if group not in user_conversations_sorted['groups_interactions']:
+                user_conversations_sorted['groups_interactions'].append(group)
+                user_conversations_sorted['group_conversations'].append({"group": group, "messages": []})
+            for conversation in user_conversations_sorted['group_conversations']:
+                if conversation['group'] == group:
+                    conversation['messages'].append(message)
+                    break
+            continue
+
         if message['sender'] != user:
             other_user = message['sender']
         else:
@@ -70,15 +107,37 @@ def load_conversations_from_user(user, filename='data/conversations.json'):
 
     return user_conversations_sorted
 
-def store_message(sender, recipient, cipher_message_for_sender, cipher_message_for_recipient, filename='data/conversations.json'):
+def save_message(message, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Append a message to the message log, and count it in the conversation index of its readers.
+
+    Args:
+        message (dict): The message, its id is given by the log.
+        directory (str): The directory of the message log. Defaults to 'data/messages'.
+
+    Returns:
+        bool: True if the message is successfully stored, False otherwise.
+    """
+    try:
+        append_message(message, directory)
+        index_message(message, directory)
+        return True
+    except IOError:
+        print("Failed to write to file.")
+        return False
+
+def store_message(sender, recipient, cipher_body, wrapped_keys, directory=MESSAGE_LOG_DIRECTORY, group=None):
     """
-    Store a message in a JSON file.
+    Store a message at the end of the message log, and count it in the conversation index of its readers.
+    If a message server is running, it stores the message (see message_server.py).
 
     Args:
         sender (str): The username of the sender.
-        recipient (str): The username of the recipient.
-        content (str): The content of the message.
-        filename (str): The path to the JSON file where messages are stored. Defaults to 'data/conversations.json'.
+        recipient (str): The username of the recipient (None for a group message).
+        cipher_body (dict): The body of the message encrypted once with the session key.
+        wrapped_keys (dict): The session key encrypted with the public key of each reader, by username.
+        directory (str): The directory of the message log, without message server. Defaults to 'data/messages'.
+        group (str): The name of the group the message is sent to. Defaults to None (a message to one user).
 
     Returns:
         bool: True if the message is successfully stored, False otherwise.
@@ -89,46 +148,404 @@ def store_message(sender, recipient, cipher_message_for_sender, cipher_message_f
         "sender": sender,
         "recipient": recipient,
         "timestamp": datetime.now().isoformat(),
-        "cipher_message_for_sender": cipher_message_for_sender,
-        "cipher_message_for_recipient": cipher_message_for_recipient
+        "cipher_body": cipher_body,
+        "wrapped_keys": wrapped_keys
     }
+    if group is not None:
+        new_message['group'] = group
 
-    conversations = load_all_conversations()
+    response = send_server_request({"command": "store_message", "message": new_message})
+    if response is not None:
+        if not response['ok']:
+            print(response['error'])
+            return False
+        new_message['id'] = response['id']
+        return True
 
-    if conversations != []:
-        new_message['id'] = conversations[-1]['id'] + 1
-    else:
-        new_message['id'] = 1
+    return save_message(new_message, directory)
+
+def cipher_message_for_users(message_content, public_keys, key_versions=None):
+    """
+    Encrypt a message once with a random session key, and wrap that session key for each reader (hybrid encryption).
+    The wrapped keys are stored as fixed-width bytes in base64 (see encode_blocks).
+
+    Args:
+        message_content (str): The content of the message.
+        public_keys (dict): The RSA public key (e, n) of each reader, by username.
+        key_versions (dict): The key version of each reader, by username, written in the header of their wrapped key. Defaults to None.
+
+    Returns:
+        tuple: A tuple containing:
+            - dict: The encrypted body of the message.
+            - dict: The wrapped session key of each reader, by username.
+    """
+    session_key = generate_session_key()
+    cipher_body = cipher_with_stream(message_content, session_key)
+
+    key_versions = key_versions or {}
+
+    wrapped_keys = {
+        username: encode_blocks(
+            cipher_bytes_with_rsa(session_key, public_key),
+            block_width=get_block_size(public_key[1]),
+            key_version=key_versions.get(username)
+        )
+        for username, public_key in public_keys.items()
+    }
+
+    return cipher_body, wrapped_keys
+
+def decipher_message_for_user(message, user, private_key):
+    """
+    Decrypt a stored message for one of its readers, whatever the way it has been stored.
+
+    Args:
+        message (dict): The stored message.
+        user (str): The username of the reader.
+        private_key (tuple): The RSA private key of the reader.
+
+    Returns:
+        str: The decrypted message.
+    """
+    if 'cipher_body' in message:
+        session_key = decipher_bytes_with_rsa(decode_blocks(message['wrapped_keys'][user]), private_key)
+        return decipher_with_stream(message['cipher_body'], session_key)
+
+    # Messages stored before hybrid encryption have one full RSA copy per reader
+    if message['sender'] == user:
+        return decipher_with_rsa(message['cipher_message_for_sender'], private_key)
+    return decipher_with_rsa(message['cipher_message_for_recipient'], private_key)
+
+def read_message_for_user(message, user, private_key):
+    """
+    Give the decrypted content of a stored message for one of its readers, decrypting it only the first time
+    it is read during the session (see plaintext_cache).
+
+    Args:
+        message (dict): The stored message.
+        user (str): The username of the reader.
+        private_key (tuple): The RSA private key of the reader.
+
+    Returns:
+        str: The decrypted message.
+    """
+    content = get_cached_plaintext(message['id'], user)
+    if content is None:
+        content = decipher_message_for_user(message, user, private_key)
+        cache_plaintext(message['id'], user, content)
+    return content
+
+def init_decryption_worker(private_key):
+    """
+    Keep the private key of the reader in a decryption worker process.
+
+    Args:
+        private_key (tuple): The RSA private key of the reader.
+
+    Returns:
+        None
+    """
+    global worker_private_key
+    worker_private_key = private_key
+
+def decipher_message_in_worker(message, user):
+    """
+    Decrypt a message in a decryption worker process, with the private key it has been started with.
+
+    Args:
+        message (dict): The stored message.
+        user (str): The username of the reader.
+
+    Returns:
+        str: The decrypted message.
+    """
+    return decipher_message_for_user(message, user, worker_private_key)
+
+def get_decryption_pool(user, private_key):
+    """
+    Give the worker processes of the session for a reader, starting them (with the private key of the reader) if needed.
 
-    conversations.append(new_message)
+    Args:
+        user (str): The username of the reader.
+        private_key (tuple): The RSA private key of the reader.
 
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: The worker processes.
+    """
+    with decryption_pool_lock:
+        if decryption_pool['executor'] is not None and (decryption_pool['user'], decryption_pool['key']) == (user, private_key):
+            return decryption_pool['executor']
+
+        if decryption_pool['executor'] is not None:
+            decryption_pool['executor'].shutdown(wait=False, cancel_futures=True)
+        decryption_pool.update({"executor": None, "user": None, "key": None})
+
+        executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, initializer=init_decryption_worker, initargs=(private_key,))
+        decryption_pool.update({"executor": executor, "user": user, "key": private_key})
+        return executor
+
+def shutdown_decryption_pool():
+    """
+    Stop the worker processes of the session (on logout), so that they do not keep the private key of the reader.
+
+    Returns:
+        None
+    """
+    with decryption_pool_lock:
+        if decryption_pool['executor'] is not None:
+            decryption_pool['executor'].shutdown(wait=False, cancel_futures=True)
+        decryption_pool.update({"executor": None, "user": None, "key": None})
+
+def decipher_messages_in_pool(messages, user, private_key):
+    """
+    Decrypt messages in the worker processes of the session, one per core, each worker receiving the private key once.
+
+    Args:
+        messages (list): The stored messages.
+        user (str): The username of the reader.
+        private_key (tuple): The RSA private key of the reader.
+
+    Yields:
+        str: The decrypted messages, in the order of the list, each one as soon as it (and the ones before it) is ready.
+    """
+    done = 0
     try:
-        with open(filename, 'w') as file:
-            json.dump(conversations, file, indent=4)
-        return True
-    except IOError:
-        print("Failed to write to file.")
-        return False
+        executor = get_decryption_pool(user, private_key)
+        chunk_size = max(1, len(messages) // ((os.cpu_count() or 1) * 4))
+        for content in executor.map(decipher_message_in_worker, messages, repeat(user), chunksize=chunk_size):
+            done += 1
+            yield content
+    except (OSError, NotImplementedError):
+        # No worker processes available on this platform: decrypt the remaining messages one after the other
+        pass
+    except BrokenProcessPool:
+        # A worker has died: the pool is started again the next time
+        shutdown_decryption_pool()
+
+    for message in messages[done:]:
+        yield decipher_message_for_user(message, user, private_key)
+
+def read_messages_for_user(messages, user, private_key, parallel=True):
+    """
+    Give the decrypted content of several stored messages for one of their readers, in order. The messages
+    that have not been read yet during the session are decrypted in worker processes if there are enough of them
+    and the machine has several CPUs.
+
+    Args:
+        messages (list): The stored messages.
+        user (str): The username of the reader.
+        private_key (tuple or dict): The RSA private key of the reader, or a key agent handle (the messages are then decrypted one after the other).
+        parallel (bool): Decrypt the messages in worker processes if possible. Defaults to True.
+
+    Yields:
+        str: The decrypted messages, in the order of the list.
+    """
+    # The cached contents are taken once, since caching the new ones may evict them from the cache
+    cached_contents = [get_cached_plaintext(message['id'], user) for message in messages]
+    missing_messages = [message for message, content in zip(messages, cached_contents) if content is None]
+
+    # With a single CPU, the workers would only add the cost of starting them and sending them the messages
+    if (not parallel or is_agent_key(private_key) or len(missing_messages) < PARALLEL_DECRYPTION_MIN_MESSAGES
+            or (os.cpu_count() or 1) < 2):
+        decrypted_contents = (decipher_message_for_user(message, user, private_key) for message in missing_messages)
+    else:
+        decrypted_contents = decipher_messages_in_pool(missing_messages, user, private_key)
+
+    for message, content in zip(messages, cached_contents):
+        if content is None:
+            content = next(decrypted_contents)
+            cache_plaintext(message['id'], user, content)
+        yield content
+
+def cipher_message_for_members(message_content, members):
+    """
+    Encrypt a message for a list of users: the body once, and the session key once per user.
+
+    Args:
+        message_content (str): The content of the message.
+        members (list): The usernames of the readers.
+
+    Returns:
+        tuple: The encrypted body and the wrapped session keys, as returned by cipher_message_for_users.
+    """
+    public_keys = {member: get_public_key_from_user(member) for member in members}
+    key_versions = {member: get_key_version_from_user(member) for member in members}
+
+    return cipher_message_for_users(message_content, public_keys, key_versions)
 
 def send_message(user, other_user, message_content):
-    """Send a message from user to another user and save it to the JSON file.
+    """Send a message from user to another user and save it to the message log.
     
+    The body is encrypted only once, and only the session key is encrypted with RSA for the sender and the recipient.
+
     Args:
         user (str): The username of the sender.
         other_user (str): The username of the recipient.
         message_content (str): The content of the message.
     """
-    sender_public_key = get_public_key_from_user(user)
-    recipient_public_key = get_public_key_from_user(other_user)
+    cipher_body, wrapped_keys = cipher_message_for_members(message_content, [user, other_user])
+
+    store_message(user, other_user, cipher_body, wrapped_keys)
+
+def send_group_message(user, group_name, message_content):
+    """Send a message from user to a group and save it to the message log.
+
+    The body is encrypted and stored only once, with the session key encrypted with RSA for each member of the group.
+
+    Args:
+        user (str): The username of the sender, a member of the group.
+        group_name (str): The name of the group.
+        message_content (str): The content of the message.
+
+    Returns:
+        bool: True if the message is successfully stored, False otherwise.
+    """
+    group = load_group(group_name)
+    if group is None or user not in group['members']:
+        print(f"You are not a member of the group {group_name}.")
+        return False
+
+    cipher_body, wrapped_keys = cipher_message_for_members(message_content, group['members'])
+
+    return store_message(user, None, cipher_body, wrapped_keys, group=group_name)
+
+def iter_conversation_newest_first(user, other_user, before_id=None, directory=MESSAGE_LOG_DIRECTORY, group=None):
+    """
+    Read the messages exchanged between two users, or the messages of a group the user can read, newest first, streaming the message log.
+
+    Args:
+        user (str): The username of the first user.
+        other_user (str): The username of the second user (ignored for a group).
+        before_id (int): Only the messages with a smaller id are given (cursor of a page). Defaults to None.
+        directory (str): The directory of the message log. Defaults to 'data/messages'.
+        group (str): The name of the group. Defaults to None (a conversation between two users).
+
+    Yields:
+        dict: Each message of the conversation, newest first.
+    """
+    for message in iter_messages_newest_first(directory, before_id):
+        if group is not None:
+            if message.get('group') == group and user in message['wrapped_keys']:
+                yield message
+        elif message.get('group') is None and (
+            (message['sender'] == user and message['recipient'] == other_user) or
+            (message['sender'] == other_user and message['recipient'] == user)
+        ):
+            yield message
+
+def load_conversation_page(user, other_user, page_size=CONVERSATION_PAGE_SIZE, before_id=None, directory=MESSAGE_LOG_DIRECTORY, group=None):
+    """
+    Load one page of the conversation between two users (or of a group): the last messages sent before a cursor.
+    If a message server is running, it gives the page from the messages it keeps in memory.
+
+    Args:
+        user (str): The username of the first user.
+        other_user (str): The username of the second user (ignored for a group).
+        page_size (int): The number of messages of the page. Defaults to CONVERSATION_PAGE_SIZE.
+        before_id (int): The cursor, only the messages with a smaller id are loaded. Defaults to None (the last messages).
+        directory (str): The directory of the message log, without message server. Defaults to 'data/messages'.
+        group (str): The name of the group. Defaults to None (a conversation between two users).
+
+    Returns:
+        tuple: A tuple containing:
+            - list: The messages of the page, oldest first.
+            - int or None: The cursor of the previous page (the id of the oldest message of this page), None if there are no older messages.
+    """
+    response = send_server_request({
+        "command": "fetch_page",
+        "user": user,
+        "other_user": other_user,
+        "page_size": page_size,
+        "before_id": before_id,
+        "group": group
+    })
+    if response is not None and response['ok']:
+        return response['messages'], response['cursor']
+
+    # One more message is read to know if there is an older page
+    messages = list(islice(iter_conversation_newest_first(user, other_user, before_id, directory, group), page_size + 1))
+
+    cursor = None
+    if len(messages) > page_size:
+        messages = messages[:page_size]
+        cursor = messages[-1]['id']
+
+    messages.reverse()
+    return messages, cursor
+
+def load_conversation_summaries(user, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the summaries of the conversations of a user, most recent activity first (see get_conversation_summaries),
+    from the message server if one is running.
+
+    Args:
+        user (str): The username.
+        directory (str): The directory of the message log, without message server. Defaults to 'data/messages'.
+
+    Returns:
+        list: The summaries of the conversations of the user.
+    """
+    response = send_server_request({"command": "get_summaries", "user": user})
+    if response is not None and response['ok']:
+        return response['summaries']
+    return get_conversation_summaries(user, directory)
+
+def load_group(name):
+    """
+    Find a group by its name (see find_group), from the message server if one is running.
 
-    cipher_message_for_sender = cipher_with_rsa(message_content,sender_public_key)
-    cipher_message_for_recipient = cipher_with_rsa(message_content,recipient_public_key)
+    Args:
+        name (str): The name of the group.
+
+    Returns:
+        dict: The group.
+        None: If there is no group with this name.
+    """
+    response = send_server_request({"command": "get_group", "name": name})
+    if response is not None and response['ok']:
+        return response['group']
+    return find_group(name)
 
-    store_message(user,other_user,cipher_message_for_sender,cipher_message_for_recipient)
+def load_groups_of_user(user):
+    """
+    Give the groups a user is a member of (see get_groups_of_user), from the message server if one is running.
+
+    Args:
+        user (str): The username.
+
+    Returns:
+        list: The groups of the user.
+    """
+    response = send_server_request({"command": "get_groups_of_user", "user": user})
+    if response is not None and response['ok']:
+        return response['groups']
+    return get_groups_of_user(user)
+
+def register_group(name, members, created_by):
+    """
+    Create a group (see create_group), through the message server if one is running.
+
+    Args:
+        name (str): The name of the group.
+        members (list): The usernames of the members (the creator is added if missing).
+        created_by (str): The username of the creator.
+
+    Returns:
+        dict: The new group.
+
+    Raises:
+        ValueError: If a group with this name already exists.
+    """
+    response = send_server_request({"command": "create_group", "name": name, "members": members, "created_by": created_by})
+    if response is None:
+        return create_group(name, members, created_by)
+    if not response['ok']:
+        raise ValueError(response['error'])
+    return response['group']
 
 def load_conversation_between_two_users(user, other_user):
     """
-    Load conversations between two specific users from a JSON file.
+    Load conversations between two specific users from the message log.
 
     Args:
         user (str): The username of the first user.
@@ -137,15 +554,9 @@ def load_conversation_between_two_users(user, other_user):
     Returns:
         list: A list of messages exchanged between the two specified users. Each message is represented as a dictionary.
     """
-    
-    conversations = load_all_conversations()
+    filtered_conversations = list(iter_conversation_newest_first(user, other_user))
+    filtered_conversations.reverse()
 
-    filtered_conversations = [
-        conversation for conversation in conversations 
-        if (conversation['sender'] == user and conversation['recipient'] == other_user) or 
-           (conversation['sender'] == other_user and conversation['recipient'] == user)
-    ]
-    
     return filtered_conversations
 
 
@@ -0,0 +1,122 @@
+import os, threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Lock files held by this process, by path: [file descriptor, depth].
+# An entry is only used by the thread holding the thread lock given with its path.
+held_file_locks = {}
+
+def acquire_file_lock(file_descriptor):
+    """
+    Wait for an exclusive advisory lock on an open lock file.
+
+    Args:
+        file_descriptor (int): The file descriptor of the lock file.
+
+    Returns:
+        None
+    """
+    if fcntl is not None:
+        fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+        return
+
+    os.lseek(file_descriptor, 0, os.SEEK_SET)
+    while True:
+        try:
+            # LK_LOCK gives up after about 10 seconds: try again until the lock is free
+            msvcrt.locking(file_descriptor, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+def release_file_lock(file_descriptor):
+    """
+    Release the advisory lock on an open lock file.
+
+    Args:
+        file_descriptor (int): The file descriptor of the lock file.
+
+    Returns:
+        None
+    """
+    if fcntl is not None:
+        fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+        return
+
+    os.lseek(file_descriptor, 0, os.SEEK_SET)
+    msvcrt.locking(file_descriptor, msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def file_lock(path, thread_lock):
+    """
+    Hold a lock shared by the threads of this process (thread_lock) and by the other processes (an advisory lock
+    on the file at path), so that several programs can use the same data directory.
+    A thread already holding the lock can take it again.
+
+    Args:
+        path (str): The path of the lock file (created if needed, its content is not used).
+        thread_lock (threading.RLock): The lock of the threads of this process, always the same one for a given path.
+
+    Yields:
+        None
+    """
+    path = os.path.abspath(path)
+    with thread_lock:
+        entry = held_file_locks.get(path)
+        if entry is not None:
+            entry[1] += 1
+            try:
+                yield
+            finally:
+                entry[1] -= 1
+            return
+
+        file_descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            acquire_file_lock(file_descriptor)
+            held_file_locks[path] = [file_descriptor, 1]
+            try:
+                yield
+            finally:
+                del held_file_locks[path]
+                release_file_lock(file_descriptor)
+        finally:
+            os.close(file_descriptor)
+
+def atomic_write(path, content, permissions=0o666, fsync=True):
+    """
+    Write a file in one step: the content is written to a temporary file next to it (its name is unique to the
+    thread, so two writers never share it), flushed to the disk, then renamed over the file.
+    A crash therefore never leaves half a file.
+
+    Args:
+        path (str): The path of the file.
+        content (str): The new content of the file.
+        permissions (int): The permissions of a new file (the umask applies). Defaults to 0o666.
+        fsync (bool): Wait for the content to be on the disk before the rename. Without it, a crash may leave an
+            empty or partial file, for files that can be rebuilt. Defaults to True.
+
+    Returns:
+        None
+    """
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    file_descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions)
+    try:
+        with os.fdopen(file_descriptor, 'w') as file:
+            file.write(content)
+            file.flush()
+            if fsync:
+                os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
@@ -1,4 +1,25 @@
-import random
+import math, random
+
+def smallPrimes(limit):
+    """Use the sieve of Eratosthenes to list the primes below a limit
+
+    Args:
+        limit (int): the upper bound (excluded)
+    Returns:
+        list: the primes lower than 'limit'
+    """
+    sieve = bytearray([1]) * limit
+    sieve[0:2] = b'\x00\x00'
+    for i in range(2, int(limit ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i*i::i] = bytes(len(range(i*i, limit, i)))
+    return [i for i in range(limit) if sieve[i]]
+
+# Small primes used to sieve the candidates before any primality test (odd primes only, 2 is skipped by using odd candidates)
+SMALL_PRIMES = smallPrimes(10000)[1:]
+
+# Number of odd candidates sieved at once
+SIEVE_WINDOW = 4096
 
 def decomposeForPrimalityTest(n):
     """Intermediate function for Rabin Miller Primality test
@@ -40,29 +61,32 @@ def proofOfMiller(n, a):
     
     return True
 
-def rabinMiller(n, k=5):
+def rabinMiller(n, k=5, rng=random):
     """Use to determine if an integer 'n' is probably prime (probabilistic)
 
     Args:
         n (int): an integer we try to apply Rabin Miller Primality test 
         k (int): number of rounds
+        rng (random.Random): the random generator used to draw the bases, the global one by default
     Returns:
         bool: this returns 'True' if 'n' is probably prime, this returns 'False' if this is not the case
     """
     # Increase k to increase the fiability of the primality test (reduce the error)
     for _ in range(k): 
-        a = random.randint(2, n - 1)
+        a = rng.randint(2, n - 1)
         if proofOfMiller(n, a):
             return False
     
     return True
 
-def isPrime(n, k=5):
-    """Use to determine if an integer 'n' is prime (use of Rabin Miller test)
+def isPrime(n, k=5, test="rabin_miller", rng=random):
+    """Use to determine if an integer 'n' is prime (use of Rabin Miller test, or Baillie-PSW test)
 
     Args:
         n (int): an integer we try to apply for the primality test 
-        k (int): number of rounds
+        k (int): number of rounds (Rabin Miller test only)
+        test (str): "rabin_miller" (probabilistic, default) or "baillie_psw" (deterministic)
+        rng (random.Random): the random generator used by the Rabin Miller test, the global one by default
     Returns:
         bool: this returns 'True' if 'n' is prime, this returns 'False' if this is not the case
     """
@@ -73,7 +97,9 @@ def isPrime(n, k=5):
     if n % 2 == 0:
         return False
     
-    return rabinMiller(n, k)
+    if test == "baillie_psw":
+        return bailliePSW(n)
+    return rabinMiller(n, k, rng)
 
 def pgcd(a, b):
     """Use in order to determine the greatest common divisor (PGCD in french)
@@ -127,23 +153,238 @@ def modularExponentiation(base, exponent, modulo):
     # (base^exponent) mod modulo
     return result
 
-def generatePrimeNumber(prime_length, seed=None):
-    """_summary_
+def generatePrimeNumber(prime_length, seed=None, rng=None):
+    """Find a prime number by drawing random numbers until one passes the primality test
 
     Args:
-        prime_length (int): _description_
+        prime_length (int): maximum number of bits of the prime
+        seed (str): the seed of the search, used to seed 'rng' (or the global random generator if no 'rng' is given)
+        rng (random.Random): the random generator used for the search, the global one by default
     Returns:
-        _type_: _description_
+        int: the prime number
     """
+    if rng is None:
+        rng = random
+
     # Seed
     if seed is not None:
-        random.seed(seed)
+        rng.seed(seed)
 
     # A number to test for primality test
-    number_to_test = random.getrandbits(prime_length)
+    number_to_test = rng.getrandbits(prime_length)
     
     # We do it until we find a correct number
-    while not isPrime(number_to_test):
-        number_to_test = random.getrandbits(prime_length)
+    while not isPrime(number_to_test, rng=rng):
+        number_to_test = rng.getrandbits(prime_length)
     
-    return number_to_test
\ No newline at end of file
+    return number_to_test
+
+def strongProbablePrime(n, a):
+    """Strong probable prime test of 'n' to the base 'a', using the builtin modular exponentiation (n must be odd)
+
+    Args:
+        n (int): an integer we try to apply the test
+        a (int): the base
+    Returns:
+        bool: this returns 'True' if 'n' is a strong probable prime to the base 'a', 'False' if 'a' proves 'n' is composite
+    """
+    s, d = decomposeForPrimalityTest(n)
+
+    x = pow(a, d, n)
+    if x == 1 or x == n - 1:
+        return True
+
+    for _ in range(s - 1):
+        x = pow(x, 2, n)
+        if x == n - 1:
+            return True
+
+    return False
+
+def millerRabin(n, k=5, rng=random):
+    """Rabin Miller Primality test using the builtin modular exponentiation (n must be odd and greater than 3)
+
+    Args:
+        n (int): an integer we try to apply Rabin Miller Primality test
+        k (int): number of rounds
+        rng (random.Random): the random generator used to draw the bases
+    Returns:
+        bool: this returns 'True' if 'n' is probably prime, this returns 'False' if this is not the case
+    """
+    for _ in range(k):
+        if not strongProbablePrime(n, rng.randint(2, n - 2)):
+            return False
+
+    return True
+
+def jacobiSymbol(a, n):
+    """Compute the Jacobi symbol (a/n)
+
+    Args:
+        a (int): an integer
+        n (int): an odd positive integer
+    Returns:
+        int: 1, -1 or 0 (when a and n are not coprime)
+    """
+    a %= n
+    result = 1
+
+    while a != 0:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+
+    return result if n == 1 else 0
+
+def lucasSequence(n, P, Q, k):
+    """Compute the terms of index 'k' of the Lucas sequences U(P, Q) and V(P, Q) modulo 'n' (n must be odd)
+
+    Args:
+        n (int): modulo
+        P (int): first parameter of the sequences
+        Q (int): second parameter of the sequences
+        k (int): index of the terms
+    Returns:
+        U: U_k mod n
+        V: V_k mod n
+        Qk: Q^k mod n
+    """
+    D = P * P - 4 * Q
+    U, V, Qk = 1, P % n, Q % n
+
+    for bit in bin(k)[3:]:
+        # Doubling: index i -> 2i
+        U = (U * V) % n
+        V = (V * V - 2 * Qk) % n
+        Qk = (Qk * Qk) % n
+
+        if bit == '1':
+            # Increment: index 2i -> 2i + 1 (the halving is done modulo n)
+            U, V = (P * U + V) % n, (D * U + P * V) % n
+            if U % 2 == 1:
+                U += n
+            if V % 2 == 1:
+                V += n
+            U, V = U // 2, V // 2
+            Qk = (Qk * Q) % n
+
+    return U, V, Qk
+
+def strongLucasProbablePrime(n):
+    """Strong Lucas probable prime test, with the parameters chosen by Selfridge's method (n must be odd and not a square)
+
+    Args:
+        n (int): an integer we try to apply the test
+    Returns:
+        bool: this returns 'True' if 'n' is a strong Lucas probable prime, 'False' if 'n' is composite
+    """
+    # First D in 5, -7, 9, -11, ... such that (D/n) = -1
+    D = 5
+    while True:
+        jacobi = jacobiSymbol(D, n)
+        if jacobi == -1:
+            break
+        if jacobi == 0 and abs(D) != n:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+
+    P, Q = 1, (1 - D) // 4
+
+    # n + 1 = d * 2^s with d odd
+    s, d = 0, n + 1
+    while d % 2 == 0:
+        s += 1
+        d //= 2
+
+    U, V, Qk = lucasSequence(n, P, Q, d)
+    if U == 0 or V == 0:
+        return True
+
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % n
+        Qk = (Qk * Qk) % n
+        if V == 0:
+            return True
+
+    return False
+
+def bailliePSW(n):
+    """Baillie-PSW Primality test: a strong test to the base 2 followed by a strong Lucas test.
+    The verdict is deterministic and no counterexample is known.
+
+    Args:
+        n (int): an integer we try to apply the test
+    Returns:
+        bool: this returns 'True' if 'n' is prime, this returns 'False' if this is not the case
+    """
+    if n < 2:
+        return False
+    for small_prime in [2] + SMALL_PRIMES[:50]:
+        if n % small_prime == 0:
+            return n == small_prime
+
+    if not strongProbablePrime(n, 2):
+        return False
+
+    # Selfridge's method never ends on a perfect square
+    if math.isqrt(n) ** 2 == n:
+        return False
+
+    return strongLucasProbablePrime(n)
+
+def sieveWindow(start, window=SIEVE_WINDOW):
+    """Sieve the odd candidates start, start + 2, ..., start + 2 * (window - 1) with the small primes
+
+    Args:
+        start (int): the first candidate (odd)
+        window (int): the number of candidates
+    Returns:
+        bytearray: for each candidate, 1 if it has no small factor, 0 otherwise
+    """
+    sieve = bytearray([1]) * window
+    for small_prime in SMALL_PRIMES:
+        # Index of the first candidate divisible by small_prime: start + 2 * i = 0 (mod small_prime)
+        i = (-start * (small_prime + 1) // 2) % small_prime
+        sieve[i::small_prime] = bytes(len(range(i, window, small_prime)))
+    return sieve
+
+def generatePrimeNumberWithSieve(prime_length, seed=None, test="baillie_psw", rng=None):
+    """Find a prime number of exactly 'prime_length' bits, searching upwards from a starting point derived from the seed.
+    Candidates are odd, sieved against the small primes, and only the survivors go through the primality test.
+
+    Args:
+        prime_length (int): number of bits of the prime
+        seed (str): the seed of the search, the same seed always gives the same prime
+        test (str): "baillie_psw" (deterministic, default) or "rabin_miller"
+        rng (random.Random): the random generator used for the search, a new one seeded with 'seed' by default
+    Returns:
+        int: the prime number
+    """
+    # Own generator, so the search does not depend on (or change) the global random state
+    if rng is None:
+        rng = random.Random(seed)
+
+    # Two top bits set so that the product of two primes has exactly 2 * prime_length bits
+    # (not enough for three primes or more: rsa_management draws them again when their product is too short)
+    start = rng.getrandbits(prime_length) | (3 << (prime_length - 2)) | 1
+
+    while True:
+        sieve = sieveWindow(start)
+        for i in range(SIEVE_WINDOW):
+            if sieve[i]:
+                candidate = start + 2 * i
+                if candidate.bit_length() > prime_length:
+                    break
+                if test == "baillie_psw":
+                    if bailliePSW(candidate):
+                        return candidate
+                elif millerRabin(candidate, rng=rng):
+                    return candidate
+        start += 2 * SIEVE_WINDOW
+        if start.bit_length() > prime_length:
+            start = rng.getrandbits(prime_length) | (3 << (prime_length - 2)) | 1
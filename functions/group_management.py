@@ -0,0 +1,87 @@
+import json, threading
+from datetime import datetime
+
+from functions.file_lock import file_lock, atomic_write
+
+GROUPS_FILENAME = 'data/groups.json'
+
+groups_lock = threading.RLock()
+
+def load_groups(filename=GROUPS_FILENAME):
+    """
+    Load the list of groups from a JSON file.
+
+    Args:
+        filename (str): The path to the JSON file where groups are stored. Defaults to 'data/groups.json'.
+
+    Returns:
+        list: The groups {"name": str, "members": [str, ...], "created_by": str, "timestamp": str}, empty if the file does not exist.
+    """
+    try:
+        with open(filename, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return []
+
+def find_group(name, filename=GROUPS_FILENAME):
+    """
+    Find a group by its name.
+
+    Args:
+        name (str): The name of the group.
+        filename (str): The path to the JSON file where groups are stored. Defaults to 'data/groups.json'.
+
+    Returns:
+        dict: The group.
+        None: If there is no group with this name.
+    """
+    for group in load_groups(filename):
+        if group['name'] == name:
+            return group
+    return None
+
+def get_groups_of_user(user, filename=GROUPS_FILENAME):
+    """
+    Give the groups a user is a member of.
+
+    Args:
+        user (str): The username.
+        filename (str): The path to the JSON file where groups are stored. Defaults to 'data/groups.json'.
+
+    Returns:
+        list: The groups of the user.
+    """
+    return [group for group in load_groups(filename) if user in group['members']]
+
+def create_group(name, members, created_by, filename=GROUPS_FILENAME):
+    """
+    Create a group and store it in the JSON file.
+
+    Args:
+        name (str): The name of the group.
+        members (list): The usernames of the members (the creator is added if missing).
+        created_by (str): The username of the creator.
+        filename (str): The path to the JSON file where groups are stored. Defaults to 'data/groups.json'.
+
+    Returns:
+        dict: The new group.
+
+    Raises:
+        ValueError: If a group with this name already exists.
+    """
+    group = {
+        "name": name,
+        "members": [created_by] + [member for member in dict.fromkeys(members) if member != created_by],
+        "created_by": created_by,
+        "timestamp": datetime.now().isoformat()
+    }
+
+    # Shared with the other programs using the same file, so that no group is lost
+    with file_lock(filename + ".lock", groups_lock):
+        groups = load_groups(filename)
+        if any(existing_group['name'] == name for existing_group in groups):
+            raise ValueError(f"The group {name} already exists")
+        groups.append(group)
+        atomic_write(filename, json.dumps(groups, indent=4))
+
+    return group
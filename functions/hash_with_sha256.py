@@ -71,6 +71,113 @@ def rotateRight(block, shift):
     """
     return rotateLeft(block, -shift)
 
+# Mask of a 32-bit word
+MASK = 0xFFFFFFFF
+
+def compressBlock(state, block):
+    """
+    Apply the compression function to one 64-byte block, working on plain 32-bit integers.
+
+    The rotations of the original implementation are applied to one-element lists, on which they leave the word unchanged,
+    so the sigma functions reduce to the word itself and 'ch' to (~e) & g. They are reproduced as such, so that every
+    digest (and so every password hash stored in users.json) stays exactly the same.
+
+    Args:
+        state (list): The eight 32-bit words of the current state.
+        block (bytes): The 64-byte block.
+    Returns:
+        list: The new state.
+    """
+    w = [int.from_bytes(block[j:j+4], 'big') for j in range(0, 64, 4)]
+    for j in range(16, 64):
+        w.append((w[j-16] + w[j-15] + w[j-7] + w[j-2]) & MASK)
+
+    a, b, c, d, e, f, g, h = state
+
+    for j in range(64):
+        temp1 = (h + e + (~e & g) + K[j] + w[j]) & MASK
+        temp2 = (a + ((a & b) ^ (a & c) ^ (b & c))) & MASK
+        h, g, f, e, d, c, b, a = g, f, e, (d + temp1) & MASK, c, b, a, (temp1 + temp2) & MASK
+
+    return [(x + y) & MASK for x, y in zip(state, (a, b, c, d, e, f, g, h))]
+
+class Sha256:
+    """
+    Incremental version of sha256(), with the same interface as the hashlib objects:
+    update() can be called several times, and copy() allows to hash several messages sharing a prefix only once.
+    """
+    name = "sha256"
+    digest_size = 32
+    block_size = 64
+
+    def __init__(self, message=b''):
+        """
+        Args:
+            message (str or bytes): The first part of the message (str are encoded in UTF-8).
+        """
+        self.state = H.copy()
+        self.buffer = b''
+        self.length = 0
+        if message:
+            self.update(message)
+
+    def update(self, message):
+        """
+        Hash another part of the message.
+
+        Args:
+            message (str or bytes): The next part of the message (str are encoded in UTF-8).
+        Returns:
+            None
+        """
+        if isinstance(message, str):
+            message = message.encode()
+
+        self.length += len(message)
+        data = self.buffer + message
+        full_length = len(data) - len(data) % 64
+
+        state = self.state
+        for i in range(0, full_length, 64):
+            state = compressBlock(state, data[i:i+64])
+
+        self.state = state
+        self.buffer = data[full_length:]
+
+    def copy(self):
+        """
+        Returns:
+            Sha256: An independent copy of the current hashing state.
+        """
+        other = Sha256()
+        other.state = self.state.copy()
+        other.buffer = self.buffer
+        other.length = self.length
+        return other
+
+    def digest(self):
+        """
+        Returns:
+            bytes: The hash of the message given so far (the object can still be updated afterwards).
+        """
+        padding = b'\x80' + b'\x00' * ((55 - self.length) % 64)
+        # As in the original implementation, the length field holds the length of the padded message minus one byte
+        message_length_bits = 8 * (self.length + len(padding) - 1)
+        data = self.buffer + padding + (message_length_bits & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'big')
+
+        state = self.state
+        for i in range(0, len(data), 64):
+            state = compressBlock(state, data[i:i+64])
+
+        return b''.join(word.to_bytes(4, 'big') for word in state)
+
+    def hexdigest(self):
+        """
+        Returns:
+            str: The hash of the message given so far, as a hexadecimal string.
+        """
+        return self.digest().hex()
+
 def sha256(message):
     """
     Compute the SHA-256 hash of the given message.
@@ -81,54 +188,4 @@ def sha256(message):
     Returns:
         str: The SHA-256 hash of the input message as a hexadecimal string.
     """
-    global H
-    
-    h0, h1, h2, h3, h4, h5, h6, h7 = H.copy()
-
-    message = message.encode()
-
-    message += b'\x80'
-    while len(message) % 64 != 56:
-        message += b'\x00'
-
-    message_length_bits = 8 * (len(message) - 1)
-    message += bytes([(message_length_bits >> (56 - i * 8)) & 0xFF for i in range(8)])
-
-    for i in range(0, len(message), 64):
-        block = message[i:i+64]
-        w = [int.from_bytes(block[j:j+4], 'big') for j in range(0, 64, 4)]
-
-        for j in range(16, 64):
-            s0 = xorSha256(rotateRight([w[j-15]], 7), xorSha256(rotateRight([w[j-15]], 18), rotateRight([w[j-15]], 3)))
-            s1 = xorSha256(rotateRight([w[j-2]], 17), xorSha256(rotateRight([w[j-2]], 19), rotateRight([w[j-2]], 10)))
-            w.append((w[j-16] + s0[0] + w[j-7] + s1[0]) & 0xFFFFFFFF)
-
-        a, b, c, d, e, f, g, h = h0, h1, h2, h3, h4, h5, h6, h7
-
-        for j in range(64):
-            s1 = xorSha256(rotateRight([e], 6), xorSha256(rotateRight([e], 11), rotateRight([e], 25)))
-            ch = xorSha256([e & f], xorSha256([(~e) & g], [e & f]))
-            temp1 = (h + s1[0] + ch[0] + K[j] + w[j]) & 0xFFFFFFFF
-            s0 = xorSha256(rotateRight([a], 2), xorSha256(rotateRight([a], 13), rotateRight([a], 22)))
-            maj = xorSha256([a & b], xorSha256([a & c], [b & c]))
-            temp2 = (s0[0] + maj[0]) & 0xFFFFFFFF
-
-            h = g
-            g = f
-            f = e
-            e = (d + temp1) & 0xFFFFFFFF
-            d = c
-            c = b
-            b = a
-            a = (temp1 + temp2) & 0xFFFFFFFF
-
-        h0 = (h0 + a) & 0xFFFFFFFF
-        h1 = (h1 + b) & 0xFFFFFFFF
-        h2 = (h2 + c) & 0xFFFFFFFF
-        h3 = (h3 + d) & 0xFFFFFFFF
-        h4 = (h4 + e) & 0xFFFFFFFF
-        h5 = (h5 + f) & 0xFFFFFFFF
-        h6 = (h6 + g) & 0xFFFFFFFF
-        h7 = (h7 + h) & 0xFFFFFFFF
-
-    return f'{h0:08x}{h1:08x}{h2:08x}{h3:08x}{h4:08x}{h5:08x}{h6:08x}{h7:08x}'
\ No newline at end of file
+    return Sha256(message).hexdigest()
@@ -0,0 +1,172 @@
+import json, os, signal, socketserver, threading, time
+
+from functions.rsa_management import decrypt_integer_with_rsa, get_modulus_from_private_key
+from functions.key_agent_client import AGENT_SOCKET_PATH, AGENT_KEY_LIFETIME, send_agent_request
+from functions.private_socket import create_private_socket_directory, remove_stale_socket
+
+# Unlocked private keys held by the agent, by username: {"key": list, "expires_at": float}
+agent_keys = {}
+agent_lock = threading.Lock()
+
+# Time (in seconds) between two purges of the expired keys
+PURGE_INTERVAL = 30
+
+def forget_agent_key(user):
+    """
+    Overwrite and drop the key of a user held by the agent (the caller holds agent_lock).
+
+    Args:
+        user (str): The username.
+
+    Returns:
+        bool: True if the agent held a key for the user.
+    """
+    entry = agent_keys.pop(user, None)
+    if entry is None:
+        return False
+    key = entry['key']
+    for i in range(len(key)):
+        key[i] = 0
+    key.clear()
+    return True
+
+def get_agent_key(user):
+    """
+    Retrieve the key of a user held by the agent, dropping it if it has expired.
+
+    Args:
+        user (str): The username.
+
+    Returns:
+        tuple: The RSA private key of the user.
+        None: If the agent does not hold a valid key for the user.
+    """
+    with agent_lock:
+        entry = agent_keys.get(user)
+        if entry is None:
+            return None
+        if time.monotonic() > entry['expires_at']:
+            forget_agent_key(user)
+            return None
+        return tuple(entry['key'])
+
+def purge_expired_keys():
+    """
+    Drop every expired key held by the agent.
+
+    Returns:
+        None
+    """
+    now = time.monotonic()
+    with agent_lock:
+        for user in [user for user, entry in agent_keys.items() if now > entry['expires_at']]:
+            forget_agent_key(user)
+
+def handle_agent_request(request):
+    """
+    Answer a request sent to the agent.
+
+    Args:
+        request (dict): The request, with a "command" field:
+            - "add_key": keep "private_key" for "user" during "lifetime" seconds.
+            - "remove_key": forget the key of "user".
+            - "has_key": tell if the agent holds a key for "user" (and its modulus).
+            - "decrypt": decrypt the RSA blocks "integers" with the key of "user".
+
+    Returns:
+        dict: The response, with an "ok" field (and an "error" field if it is False).
+    """
+    command = request.get('command')
+    user = request.get('user')
+
+    if command == "add_key":
+        lifetime = request.get('lifetime', AGENT_KEY_LIFETIME)
+        with agent_lock:
+            forget_agent_key(user)
+            agent_keys[user] = {"key": list(request['private_key']), "expires_at": time.monotonic() + lifetime}
+        return {"ok": True}
+
+    if command == "remove_key":
+        with agent_lock:
+            return {"ok": forget_agent_key(user)}
+
+    private_key = get_agent_key(user)
+    if command not in ("has_key", "decrypt"):
+        return {"ok": False, "error": f"Unknown command {command}"}
+    if private_key is None:
+        return {"ok": False, "error": f"No key for {user}"}
+
+    if command == "has_key":
+        return {"ok": True, "modulus": get_modulus_from_private_key(private_key)}
+
+    return {"ok": True, "integers": [decrypt_integer_with_rsa(integer, private_key) for integer in request['integers']]}
+
+class KeyAgentRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Read one JSON request line from a client and write back one JSON response line.
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            response = handle_agent_request(json.loads(line))
+        except (ValueError, KeyError, TypeError) as error:
+            response = {"ok": False, "error": str(error)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+def run_key_agent(socket_path=AGENT_SOCKET_PATH):
+    """
+    Run the key agent in the foreground until it is interrupted (CTRL + C or SIGTERM).
+
+    Args:
+        socket_path (str): The path of the agent socket. Defaults to AGENT_SOCKET_PATH.
+
+    Returns:
+        None
+    """
+    if not create_private_socket_directory(socket_path):
+        print(f"The directory of {socket_path} is not private to the current user")
+        return
+    if send_agent_request({"command": "has_key", "user": None}, socket_path) is not None:
+        print(f"A key agent is already running on {socket_path}")
+        return
+    # Socket left by an agent that has stopped (never one of another user)
+    if not remove_stale_socket(socket_path):
+        print(f"{socket_path} belongs to another user")
+        return
+
+    # Only the current user can connect to the socket
+    previous_umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, KeyAgentRequestHandler)
+    finally:
+        os.umask(previous_umask)
+    server.daemon_threads = True
+
+    purge_stop_event = threading.Event()
+
+    def stop_agent(signal_number, frame):
+        raise KeyboardInterrupt
+
+    # Stopping the agent (kill) also removes its socket and forgets the keys
+    signal.signal(signal.SIGTERM, stop_agent)
+
+    def purge_loop():
+        while not purge_stop_event.wait(PURGE_INTERVAL):
+            purge_expired_keys()
+
+    threading.Thread(target=purge_loop, daemon=True).start()
+
+    print(f"Key agent listening on {socket_path}")
+    print(f"CIPHER_MESSAGING_AGENT_SOCK={socket_path}; export CIPHER_MESSAGING_AGENT_SOCK;")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        purge_stop_event.set()
+        server.server_close()
+        os.remove(socket_path)
+        with agent_lock:
+            for user in list(agent_keys):
+                forget_agent_key(user)
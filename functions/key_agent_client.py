@@ -0,0 +1,144 @@
+import json, os, socket
+
+from functions.private_socket import PRIVATE_SOCKET_DIRECTORY, is_private_socket
+
+# Unix socket of the key agent (see key_agent.py), in a directory only accessible to the current user.
+# Can be changed with the CIPHER_MESSAGING_AGENT_SOCK environment variable.
+AGENT_SOCKET_PATH = os.environ.get(
+    "CIPHER_MESSAGING_AGENT_SOCK",
+    os.path.join(PRIVATE_SOCKET_DIRECTORY, "agent.sock")
+)
+
+# Time (in seconds) the agent keeps a key added by the client
+AGENT_KEY_LIFETIME = 60 * 60
+
+def send_agent_request(request, socket_path=AGENT_SOCKET_PATH):
+    """
+    Send a request to the key agent and wait for its response (one JSON line each way).
+
+    Args:
+        request (dict): The request, with a "command" field.
+        socket_path (str): The path of the agent socket. Defaults to AGENT_SOCKET_PATH.
+
+    Returns:
+        dict: The response of the agent, with an "ok" field.
+        None: If no agent is running, if the socket belongs to another user (or Unix sockets are not available on this platform).
+    """
+    # The private keys are only sent to a socket of the current user
+    if not hasattr(socket, "AF_UNIX") or not is_private_socket(socket_path):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as agent_socket:
+            agent_socket.connect(socket_path)
+            agent_socket.sendall(json.dumps(request).encode() + b'\n')
+            with agent_socket.makefile('rb') as agent_file:
+                response = agent_file.readline()
+    except OSError:
+        return None
+
+    if not response:
+        return None
+    return json.loads(response)
+
+def is_agent_key(private_key):
+    """
+    Check if a private key is a handle on a key held by the agent rather than the key itself.
+
+    Args:
+        private_key (tuple or dict): The private key.
+
+    Returns:
+        bool: True if the key is held by the agent.
+    """
+    return isinstance(private_key, dict) and "agent" in private_key
+
+def agent_add_key(user, private_key, lifetime=AGENT_KEY_LIFETIME, socket_path=AGENT_SOCKET_PATH):
+    """
+    Give an unlocked private key to the agent.
+
+    Args:
+        user (str): The username.
+        private_key (tuple): The RSA private key of the user.
+        lifetime (float): The time (in seconds) the agent keeps the key. Defaults to AGENT_KEY_LIFETIME.
+        socket_path (str): The path of the agent socket. Defaults to AGENT_SOCKET_PATH.
+
+    Returns:
+        bool: True if the agent holds the key, False otherwise (no agent running).
+    """
+    response = send_agent_request({
+        "command": "add_key",
+        "user": user,
+        "private_key": list(private_key),
+        "lifetime": lifetime
+    }, socket_path)
+    return response is not None and response['ok']
+
+def agent_remove_key(user, socket_path=AGENT_SOCKET_PATH):
+    """
+    Ask the agent to forget the private key of a user.
+
+    Args:
+        user (str): The username.
+        socket_path (str): The path of the agent socket. Defaults to AGENT_SOCKET_PATH.
+
+    Returns:
+        bool: True if the agent held the key, False otherwise.
+    """
+    response = send_agent_request({"command": "remove_key", "user": user}, socket_path)
+    return response is not None and response['ok']
+
+def agent_get_key(user, socket_path=AGENT_SOCKET_PATH):
+    """
+    Get a handle on the private key of a user held by the agent. The key itself never leaves the agent.
+
+    Args:
+        user (str): The username.
+        socket_path (str): The path of the agent socket. Defaults to AGENT_SOCKET_PATH.
+
+    Returns:
+        dict: The handle {"agent": socket path, "user": username, "modulus": n}, usable as a private key by rsa_management.
+        None: If no agent is running or it does not hold the key.
+    """
+    response = send_agent_request({"command": "has_key", "user": user}, socket_path)
+    if response is None or not response['ok']:
+        return None
+    return {"agent": socket_path, "user": user, "modulus": response['modulus']}
+
+def agent_still_has_key(agent_key):
+    """
+    Check that the agent still holds the key of a handle (it may have expired or the agent may have stopped).
+
+    Args:
+        agent_key (dict): The handle returned by agent_get_key.
+
+    Returns:
+        bool: True if the handle can still be used.
+    """
+    current_key = agent_get_key(agent_key['user'], agent_key['agent'])
+    # The agent may hold another key for the user since the handle was given
+    return current_key is not None and current_key['modulus'] == agent_key['modulus']
+
+def agent_decrypt_integers(agent_key, cipher_integers):
+    """
+    Ask the agent to decrypt RSA blocks with the key of a handle.
+
+    Args:
+        agent_key (dict): The handle returned by agent_get_key.
+        cipher_integers (list): The encrypted blocks.
+
+    Returns:
+        list: The decrypted blocks.
+
+    Raises:
+        ValueError: If the agent is not running anymore or does not hold the key.
+    """
+    response = send_agent_request({
+        "command": "decrypt",
+        "user": agent_key['user'],
+        "integers": list(cipher_integers)
+    }, agent_key['agent'])
+
+    if response is None or not response['ok']:
+        raise ValueError(f"The key agent cannot decrypt for {agent_key['user']}")
+    return response['integers']
@@ -0,0 +1,151 @@
+import threading, time
+
+# Idle time (in seconds) after which an unlocked private key is forgotten, None to keep it until logout
+KEY_CACHE_TTL = 15 * 60
+
+# Unlocked private keys of the session, by username: {"key": list, "last_used": float}
+cached_keys = {}
+# Private keys being derived in the background, by username: concurrent.futures.Future
+pending_keys = {}
+cache_lock = threading.RLock()
+
+def wipe_key_entry(entry):
+    """
+    Overwrite the key material of a cache entry before dropping it.
+
+    Args:
+        entry (dict): The cache entry.
+
+    Notes:
+        - Python integers cannot be erased in place, so this only drops every reference the cache holds (best effort).
+    """
+    key = entry['key']
+    if isinstance(key, list):
+        for i in range(len(key)):
+            key[i] = 0
+    key.clear()
+
+def cache_private_key(user, private_key):
+    """
+    Keep the unlocked private key of a user in memory for the session.
+
+    Args:
+        user (str): The username.
+        private_key (tuple or dict): The RSA private key of the user, or a handle on the key held by the key agent.
+
+    Returns:
+        None
+    """
+    with cache_lock:
+        if user in cached_keys:
+            wipe_key_entry(cached_keys.pop(user))
+        key = dict(private_key) if isinstance(private_key, dict) else list(private_key)
+        cached_keys[user] = {"key": key, "last_used": time.monotonic()}
+
+def get_cached_private_key(user, ttl=None):
+    """
+    Retrieve the unlocked private key of a user, if it is cached and has been used recently enough.
+
+    Args:
+        user (str): The username.
+        ttl (float): The idle time (in seconds) after which the key is evicted. Defaults to KEY_CACHE_TTL.
+
+    Returns:
+        tuple or dict: The RSA private key of the user (or the handle on the key held by the key agent).
+        None: If the key is not cached or has expired (it is then evicted).
+    """
+    if ttl is None:
+        ttl = KEY_CACHE_TTL
+
+    with cache_lock:
+        entry = cached_keys.get(user)
+        if entry is None:
+            return None
+
+        now = time.monotonic()
+        if ttl is not None and now - entry['last_used'] > ttl:
+            wipe_key_entry(cached_keys.pop(user))
+            return None
+
+        entry['last_used'] = now
+        key = entry['key']
+        return dict(key) if isinstance(key, dict) else tuple(key)
+
+def set_pending_private_key(user, future):
+    """
+    Register the private key of a user being derived in the background. It is cached as soon as it is ready.
+
+    Args:
+        user (str): The username.
+        future (concurrent.futures.Future): The future of the private key.
+
+    Returns:
+        None
+    """
+    with cache_lock:
+        pending_keys[user] = future
+    future.add_done_callback(lambda done_future: store_pending_private_key(user, done_future))
+
+def get_pending_private_key(user):
+    """
+    Retrieve the future of the private key of a user being derived in the background.
+
+    Args:
+        user (str): The username.
+
+    Returns:
+        concurrent.futures.Future: The future of the private key.
+        None: If no key is being derived for the user.
+    """
+    with cache_lock:
+        return pending_keys.get(user)
+
+def store_pending_private_key(user, future):
+    """
+    Move a private key derived in the background into the cache, unless it has been evicted meanwhile.
+
+    Args:
+        user (str): The username.
+        future (concurrent.futures.Future): The finished future of the private key.
+
+    Returns:
+        None
+    """
+    with cache_lock:
+        if pending_keys.get(user) is not future:
+            return
+        del pending_keys[user]
+        if not future.cancelled() and future.exception() is None:
+            cache_private_key(user, future.result())
+
+def evict_private_key(user):
+    """
+    Forget the unlocked private key of a user (on logout), and drop the key being derived for them if any.
+
+    Args:
+        user (str): The username.
+
+    Returns:
+        None
+    """
+    with cache_lock:
+        future = pending_keys.pop(user, None)
+        if future is not None:
+            future.cancel()
+        if user in cached_keys:
+            wipe_key_entry(cached_keys.pop(user))
+
+def clear_key_cache():
+    """
+    Forget every unlocked private key of the session.
+
+    Returns:
+        None
+    """
+    with cache_lock:
+        for future in pending_keys.values():
+            future.cancel()
+        pending_keys.clear()
+        for entry in cached_keys.values():
+            wipe_key_entry(entry)
+        cached_keys.clear()
@@ -0,0 +1,110 @@
+import json, os
+
+from functions.hash_with_sha256 import sha256
+from functions.rsa_management import get_modulus_from_private_key
+from functions.stream_cipher import cipher_with_stream, decipher_with_stream
+from functions.user_directory import encode_username
+from functions.file_lock import atomic_write
+
+# Opt-in: set the CIPHER_MESSAGING_KEY_FILES environment variable to 1 to keep password-wrapped private keys on disk
+KEY_FILE_CACHE_ENABLED = os.environ.get("CIPHER_MESSAGING_KEY_FILES") == "1"
+KEY_FILE_DIRECTORY = 'data/keys'
+
+# Format of the key files, and number of SHA256 iterations used to stretch the password of new key files
+KEY_FILE_VERSION = 1
+KEY_FILE_ITERATIONS = 100
+SALT_LENGTH = 16
+
+def get_key_file_path(user, directory=KEY_FILE_DIRECTORY):
+    """
+    Give the path of the key file of a user, named after the encoded username (see encode_username).
+
+    Args:
+        user (str): The username.
+        directory (str): The directory of the key files. Defaults to KEY_FILE_DIRECTORY.
+
+    Returns:
+        str: The path of the key file.
+    """
+    return os.path.join(directory, f"{encode_username(user)}.key.json")
+
+def stretch_password(password, salt, iterations):
+    """
+    Derive a wrapping key from a password by hashing it again and again with SHA256.
+
+    Args:
+        password (str): The clear password.
+        salt (bytes): The random salt of the key file.
+        iterations (int): The number of SHA256 iterations.
+
+    Returns:
+        bytes: The 32-byte wrapping key.
+    """
+    digest = sha256(salt.hex() + password)
+    for _ in range(iterations - 1):
+        digest = sha256(digest + salt.hex())
+    return bytes.fromhex(digest)
+
+def store_key_file(user, password, private_key, directory=KEY_FILE_DIRECTORY):
+    """
+    Write the private key of a user on disk, encrypted with a key stretched from their password.
+
+    Args:
+        user (str): The username.
+        password (str): The clear password of the user.
+        private_key (tuple): The RSA private key of the user.
+        directory (str): The directory of the key files. Defaults to KEY_FILE_DIRECTORY.
+
+    Returns:
+        bool: True if the key file is written, False otherwise.
+    """
+    salt = os.urandom(SALT_LENGTH)
+    wrapping_key = stretch_password(password, salt, KEY_FILE_ITERATIONS)
+
+    key_file = {
+        "version": KEY_FILE_VERSION,
+        "salt": salt.hex(),
+        "iterations": KEY_FILE_ITERATIONS,
+        "wrapped_key": cipher_with_stream(json.dumps(list(private_key)), wrapping_key)
+    }
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Readable by the current user only
+        atomic_write(get_key_file_path(user, directory), json.dumps(key_file), permissions=0o600)
+        return True
+    except OSError:
+        print("Failed to write the key file.")
+        return False
+
+def load_key_file(user, password, public_key, directory=KEY_FILE_DIRECTORY):
+    """
+    Read the private key of a user from their key file.
+
+    Args:
+        user (str): The username.
+        password (str): The clear password of the user.
+        public_key (tuple): The RSA public key (e, n) of the user, to check the unwrapped key against.
+        directory (str): The directory of the key files. Defaults to KEY_FILE_DIRECTORY.
+
+    Returns:
+        tuple: The RSA private key of the user.
+        None: If the key file is missing, unreadable, fails its integrity check or does not match the public key.
+    """
+    try:
+        with open(get_key_file_path(user, directory), 'r') as file:
+            key_file = json.load(file)
+
+        if key_file['version'] != KEY_FILE_VERSION:
+            return None
+
+        wrapping_key = stretch_password(password, bytes.fromhex(key_file['salt']), key_file['iterations'])
+        private_key = tuple(json.loads(decipher_with_stream(key_file['wrapped_key'], wrapping_key)))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    # The key must belong to the stored public key
+    if get_modulus_from_private_key(private_key) != public_key[1]:
+        return None
+
+    return private_key
@@ -0,0 +1,519 @@
+import json, mmap, os, threading
+from concurrent.futures import Future
+
+from functions.file_lock import file_lock, atomic_write
+from functions.rsa_management import encode_blocks, LEGACY_KEY_VERSION, LEGACY_MESSAGE_FORMAT
+
+# Messages are stored in an append-only log: segments of JSON Lines (one record per line),
+# and a small header holding the next message id and the list of segments.
+MESSAGE_LOG_DIRECTORY = 'data/messages'
+LEGACY_CONVERSATIONS_FILENAME = 'data/conversations.json'
+HEADER_FILENAME = 'header.json'
+# Held while the log is written, by the threads of a process and by the other processes using the same directory
+LOCK_FILENAME = 'log.lock'
+LOG_FORMAT_VERSION = 1
+
+# A new segment is started when the active one is bigger than this
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+# A background compaction is started when this number of messages have been deleted since the last one
+TOMBSTONES_BEFORE_COMPACTION = 100
+
+log_lock = threading.RLock()
+
+# Directories of the logs being compacted by this process
+compacting_directories = set()
+compaction_lock = threading.Lock()
+
+# Group commit: messages waiting to be appended, by directory: [(message, Future), ...].
+# The thread that gets the log lock appends every waiting message with a single fsync.
+pending_messages = {}
+pending_lock = threading.Lock()
+
+def get_log_path(filename, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the path of a file of the message log.
+
+    Args:
+        filename (str): The name of the file (header or segment).
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        str: The path of the file.
+    """
+    return os.path.join(directory, filename)
+
+def lock_message_log(directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the lock of the message log, held while it is written (see file_lock).
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        contextmanager: The lock, to use in a with statement.
+    """
+    os.makedirs(directory, exist_ok=True)
+    return file_lock(get_log_path(LOCK_FILENAME, directory), log_lock)
+
+def write_log_header(header, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Write the header of the message log, replacing the previous one in one step.
+
+    Args:
+        header (dict): The header {"version": int, "next_id": int, "next_segment": int, "segments": [str, ...], "tombstones": int, "deleted": int,
+            "retired_segments": [str, ...]} (the segments replaced by the last compaction, see compact_message_log).
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    atomic_write(get_log_path(HEADER_FILENAME, directory), json.dumps(header))
+
+def create_message_log(directory=MESSAGE_LOG_DIRECTORY, legacy_filename=LEGACY_CONVERSATIONS_FILENAME):
+    """
+    Create an empty message log, and import the messages of the legacy JSON file if there is one.
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+        legacy_filename (str): The JSON file used before the message log. Defaults to LEGACY_CONVERSATIONS_FILENAME.
+
+    Returns:
+        dict: The header of the new message log.
+    """
+    header = {"version": LOG_FORMAT_VERSION, "next_id": 1, "next_segment": 1, "segments": [], "tombstones": 0, "deleted": 0}
+    header = start_new_segment(header, directory)
+
+    # The header is written last: if the import fails or is interrupted, the log does not exist yet and the next call imports again
+    if legacy_filename is not None:
+        import_conversations_json(header, legacy_filename, directory)
+    write_log_header(header, directory)
+
+    return header
+
+def load_log_header(directory=MESSAGE_LOG_DIRECTORY, legacy_filename=LEGACY_CONVERSATIONS_FILENAME):
+    """
+    Load the header of the message log, creating the log if it does not exist yet.
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+        legacy_filename (str): The JSON file imported when the log is created. Defaults to LEGACY_CONVERSATIONS_FILENAME.
+
+    Returns:
+        dict: The header of the message log.
+    """
+    # The header is replaced in one step, so it can be read without the lock
+    try:
+        with open(get_log_path(HEADER_FILENAME, directory), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        pass
+
+    with lock_message_log(directory):
+        # Another program may have created the log meanwhile
+        try:
+            with open(get_log_path(HEADER_FILENAME, directory), 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return create_message_log(directory, legacy_filename)
+
+def start_new_segment(header, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Add a new empty segment at the end of the log (the header still has to be written).
+
+    Args:
+        header (dict): The header of the message log.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        dict: The updated header.
+    """
+    segment = f"segment_{header['next_segment']:06d}.jsonl"
+    # Not in the header yet: a file with this name can only be left by an interrupted write, and is emptied
+    open(get_log_path(segment, directory), 'w').close()
+    header['segments'].append(segment)
+    header['next_segment'] += 1
+    return header
+
+def encode_log_records(records):
+    """
+    Give the lines of records in a segment.
+
+    Args:
+        records (list): The records (dictionaries).
+
+    Returns:
+        bytes: One JSON line per record.
+    """
+    return ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records).encode()
+
+def append_log_records(records, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Append records at the end of the active segment of the log.
+
+    Args:
+        records (list): The records (dictionaries) to append.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    with lock_message_log(directory):
+        header = load_log_header(directory)
+        segment_path = get_log_path(header['segments'][-1], directory)
+
+        if os.path.getsize(segment_path) > SEGMENT_MAX_BYTES:
+            header = start_new_segment(header, directory)
+            write_log_header(header, directory)
+            segment_path = get_log_path(header['segments'][-1], directory)
+
+        lines = encode_log_records(records)
+        with open(segment_path, 'a+b') as file:
+            # A line cut by a crash is closed first, so that it does not swallow the new records
+            if file.tell() > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    lines = b'\n' + lines
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+def commit_messages(messages, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the next ids to messages and append them to the log, with one write of the header and one fsync of the segment.
+
+    Args:
+        messages (list): The messages, their "id" field is set by this function.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    with lock_message_log(directory):
+        header = load_log_header(directory)
+
+        # The ids are reserved before the messages are written: a crash in between only leaves a gap in the ids
+        for message in messages:
+            message['id'] = header['next_id']
+            header['next_id'] += 1
+        write_log_header(header, directory)
+
+        append_log_records(messages, directory)
+
+def append_message(message, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give the next id to a message and append it to the log. Only the header and the end of the active segment are written.
+    The messages appended at the same time by other threads are written with it (group commit).
+
+    Args:
+        message (dict): The message, its "id" field is set by this function.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        int: The id of the message.
+    """
+    future = Future()
+    with pending_lock:
+        pending_messages.setdefault(directory, []).append((message, future))
+
+    with lock_message_log(directory):
+        # The message may have been written by the thread that had the lock before
+        if not future.done():
+            with pending_lock:
+                batch = pending_messages.pop(directory, [])
+            try:
+                commit_messages([pending_message for pending_message, _ in batch], directory)
+            except Exception as error:
+                for _, pending_future in batch:
+                    pending_future.set_exception(error)
+            else:
+                for pending_message, pending_future in batch:
+                    pending_future.set_result(pending_message['id'])
+
+    return future.result()
+
+def delete_message(message_id, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Delete a message by appending a tombstone to the log. The message is removed from the segments by the next compaction.
+
+    Args:
+        message_id (int): The id of the message.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    with lock_message_log(directory):
+        header = load_log_header(directory)
+        header['tombstones'] += 1
+        # Unlike the tombstones, this count is never reset: it tells the conversation indexes that messages have been deleted
+        header['deleted'] = header.get('deleted', 0) + 1
+        write_log_header(header, directory)
+
+        append_log_records([{"tombstone": message_id}], directory)
+
+        if header['tombstones'] >= TOMBSTONES_BEFORE_COMPACTION:
+            with compaction_lock:
+                start_compaction = directory not in compacting_directories
+                compacting_directories.add(directory)
+            if start_compaction:
+                threading.Thread(target=compact_message_log, args=(directory,), daemon=True).start()
+
+def iter_segment_records(segment_path):
+    """
+    Read the records of a segment in order.
+
+    Args:
+        segment_path (str): The path of the segment.
+
+    Yields:
+        dict: Each record. A line cut by a crash during an append is skipped.
+    """
+    try:
+        with open(segment_path, 'r') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return
+
+def iter_log_records(directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Read every record of the log in order (messages and tombstones).
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Yields:
+        dict: Each record.
+    """
+    header = load_log_header(directory)
+    for segment in header['segments']:
+        yield from iter_segment_records(get_log_path(segment, directory))
+
+def iter_segment_records_reversed(segment_path):
+    """
+    Read the records of a segment from the last one to the first one, through a memory map of the file
+    (only the pages holding the records that are actually read are loaded).
+
+    Args:
+        segment_path (str): The path of the segment.
+
+    Yields:
+        dict: Each record, newest first. A line cut by a crash during an append is skipped.
+    """
+    try:
+        file = open(segment_path, 'rb')
+    except FileNotFoundError:
+        return
+
+    with file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = len(data)
+            while end > 0:
+                # The line ends at 'end' (its line break included), and starts after the previous line break
+                start = data.rfind(b'\n', 0, end - 1) + 1
+                line = data[start:end]
+                end = start
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def iter_log_records_reversed(directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Read every record of the log from the newest one to the oldest one (messages and tombstones).
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Yields:
+        dict: Each record, newest first.
+    """
+    header = load_log_header(directory)
+    for segment in reversed(header['segments']):
+        yield from iter_segment_records_reversed(get_log_path(segment, directory))
+
+def iter_messages_newest_first(directory=MESSAGE_LOG_DIRECTORY, before_id=None):
+    """
+    Read the messages of the log that have not been deleted, newest first, without loading the whole log.
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+        before_id (int): Only the messages with a smaller id are given (cursor of a page). Defaults to None.
+
+    Yields:
+        dict: Each message, newest first.
+    """
+    # A tombstone is always written after the message it deletes, so it is read before it
+    deleted_ids = set()
+    for record in iter_log_records_reversed(directory):
+        if 'tombstone' in record:
+            deleted_ids.add(record['tombstone'])
+        elif record['id'] not in deleted_ids and (before_id is None or record['id'] < before_id):
+            yield record
+
+def load_messages(directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Load every message of the log that has not been deleted, in order.
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        list: The messages.
+    """
+    messages = {}
+    for record in iter_log_records(directory):
+        if 'tombstone' in record:
+            messages.pop(record['tombstone'], None)
+        else:
+            messages[record['id']] = record
+    return list(messages.values())
+
+def read_messages_since(next_id, deleted, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Give what has changed in the log since a state of it known by the caller (a conversation index, the messages kept
+    in memory by the message server): the messages written since, or every message if messages have been deleted since.
+
+    Args:
+        next_id (int): The next message id of the known state.
+        deleted (int): The number of deleted messages of the known state (None if nothing is known).
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        tuple: A tuple containing:
+            - bool: True if messages have been deleted since: the caller forgets what it knows, the messages are then every message of the log.
+            - list: The new messages, oldest first.
+            - dict: The new state {"next_id": int, "deleted": int}.
+    """
+    # Read with the log lock held: every message with a smaller id than "next_id" is then written in the log
+    with lock_message_log(directory):
+        header = load_log_header(directory)
+    state = {"next_id": header['next_id'], "deleted": header.get('deleted', 0)}
+
+    reset = deleted != state['deleted']
+    if reset:
+        next_id = 1
+
+    # Only the messages before the header read above are given: a message appended meanwhile is given by the next call
+    messages = []
+    if next_id != state['next_id']:
+        for message in iter_messages_newest_first(directory, before_id=state['next_id']):
+            if message['id'] < next_id:
+                break
+            messages.append(message)
+        messages.reverse()
+
+    return reset, messages, state
+
+def compact_message_log(directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Merge the segments of the log into new ones, without the deleted messages and the tombstones.
+    The replaced segments are only removed by the next compaction: the programs reading the log without the lock
+    (with the header they have read before this compaction) can still read them meanwhile.
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    try:
+        with lock_message_log(directory):
+            header = load_log_header(directory)
+            old_segments = header['segments']
+            retired_segments = header.get('retired_segments', [])
+            messages = load_messages(directory)
+
+            # The new segments are written next to the old ones, and the header switches to them in one step
+            header['segments'] = []
+            header['tombstones'] = 0
+            header = start_new_segment(header, directory)
+            segment_path = get_log_path(header['segments'][-1], directory)
+            file = open(segment_path, 'a')
+            try:
+                for message in messages:
+                    if file.tell() > SEGMENT_MAX_BYTES:
+                        file.flush()
+                        os.fsync(file.fileno())
+                        file.close()
+                        header = start_new_segment(header, directory)
+                        segment_path = get_log_path(header['segments'][-1], directory)
+                        file = open(segment_path, 'a')
+                    file.write(json.dumps(message, separators=(',', ':')) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            finally:
+                file.close()
+
+            header['retired_segments'] = old_segments
+            write_log_header(header, directory)
+
+            # The segments retired by the previous compaction are in no header anymore
+            kept_segments = []
+            for segment in retired_segments:
+                try:
+                    os.remove(get_log_path(segment, directory))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # Still open by a reader (Windows): removed by the next compaction
+                    kept_segments.append(segment)
+            if kept_segments:
+                header['retired_segments'] += kept_segments
+                write_log_header(header, directory)
+    finally:
+        with compaction_lock:
+            compacting_directories.discard(directory)
+
+def encode_legacy_message(message):
+    """
+    Encode the per-character ciphertexts of a message of the legacy JSON file as fixed-width bytes (see encode_blocks).
+
+    Args:
+        message (dict): The message, with "cipher_message_for_sender" and "cipher_message_for_recipient" lists of integers.
+
+    Returns:
+        dict: The message with its ciphertexts encoded.
+    """
+    for field in ("cipher_message_for_sender", "cipher_message_for_recipient"):
+        if isinstance(message.get(field), list):
+            message[field] = encode_blocks(message[field], block_format=LEGACY_MESSAGE_FORMAT, key_version=LEGACY_KEY_VERSION)
+    return message
+
+def import_conversations_json(header, filename=LEGACY_CONVERSATIONS_FILENAME, directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Import the messages of the JSON file used before the message log into the first segment of a new log
+    (the file itself is left untouched). Their ciphertexts are stored encoded, which makes the log about 2.5 times
+    smaller than the JSON file. The header of the log still has to be written.
+
+    Args:
+        header (dict): The header of the new log, its "next_id" is updated.
+        filename (str): The JSON file. Defaults to LEGACY_CONVERSATIONS_FILENAME.
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        int: The number of imported messages.
+
+    Raises:
+        json.JSONDecodeError: If the JSON file is damaged (nothing is imported, and the log is not created).
+    """
+    try:
+        with open(filename, 'r') as file:
+            conversations = json.load(file)
+    except FileNotFoundError:
+        return 0
+
+    with open(get_log_path(header['segments'][0], directory), 'wb') as file:
+        file.write(encode_log_records([encode_legacy_message(message) for message in conversations]))
+        file.flush()
+        os.fsync(file.fileno())
+
+    # The messages keep their ids
+    header['next_id'] = max([header['next_id']] + [message['id'] + 1 for message in conversations])
+
+    return len(conversations)
@@ -0,0 +1,330 @@
+import asyncio, json, os, signal, socket, threading
+
+from functions.message_log import MESSAGE_LOG_DIRECTORY, read_messages_since
+from functions.conversation_index import get_conversation_summaries, get_message_readers
+from functions.conversation_management import CONVERSATION_PAGE_SIZE, save_message
+from functions.group_management import find_group, get_groups_of_user, create_group
+from functions.user_directory import get_user_directory, find_user, add_user
+from functions.message_server_client import SERVER_ADDRESS, parse_server_address, send_server_request
+from functions.private_socket import create_private_socket_directory, remove_stale_socket
+
+# Maximum length (in bytes) of a request line, a long message being sent in one line
+SERVER_LINE_LIMIT = 16 * 1024 * 1024
+
+# Fields of a user record given to the clients (the password hash stays in the server)
+PUBLIC_USER_FIELDS = ("username", "public_key", "key_version")
+
+# Fields of a message record accepted from the clients (the id is given by the log)
+MESSAGE_FIELDS = ("sender", "recipient", "timestamp", "cipher_body", "wrapped_keys", "group")
+
+# Messages of the log kept in memory by the server, by conversation (see get_conversation_key), oldest first.
+# "next_id" and "deleted" tell which state of the log they describe, like a conversation index.
+resident_messages = {"next_id": 1, "deleted": None, "conversations": {}}
+resident_lock = threading.Lock()
+
+def get_conversation_key(user, other_user, group=None):
+    """
+    Give the key of a conversation in the resident messages.
+
+    Args:
+        user (str): The username of the first user.
+        other_user (str): The username of the second user (ignored for a group).
+        group (str): The name of the group. Defaults to None (a conversation between two users).
+
+    Returns:
+        tuple: ("group", name) for a group, ("users", first username, second username) otherwise.
+    """
+    if group is not None:
+        return ("group", group)
+    return ("users",) + tuple(sorted((user, other_user)))
+
+def refresh_resident_messages(directory=MESSAGE_LOG_DIRECTORY):
+    """
+    Bring the resident messages up to date with the log: the messages written since the last refresh (by the server,
+    or by a program using the files itself) are added, and everything is loaded again if messages have been deleted.
+
+    Args:
+        directory (str): The directory of the message log. Defaults to MESSAGE_LOG_DIRECTORY.
+
+    Returns:
+        None
+    """
+    with resident_lock:
+        reset, messages, state = read_messages_since(resident_messages['next_id'], resident_messages['deleted'], directory)
+        if reset:
+            resident_messages['conversations'] = {}
+
+        for message in messages:
+            key = get_conversation_key(message['sender'], message['recipient'], message.get('group'))
+            resident_messages['conversations'].setdefault(key, []).append(message)
+
+        resident_messages.update(state)
+
+def get_resident_page(user, other_user, page_size=CONVERSATION_PAGE_SIZE, before_id=None, group=None):
+    """
+    Give one page of a conversation from the resident messages (same page as load_conversation_page).
+
+    Args:
+        user (str): The username of the first user.
+        other_user (str): The username of the second user (ignored for a group).
+        page_size (int): The number of messages of the page. Defaults to CONVERSATION_PAGE_SIZE.
+        before_id (int): The cursor, only the messages with a smaller id are given. Defaults to None (the last messages).
+        group (str): The name of the group. Defaults to None (a conversation between two users).
+
+    Returns:
+        tuple: The messages of the page (oldest first) and the cursor of the previous page (None if there are no older messages).
+    """
+    refresh_resident_messages()
+
+    messages = []
+    with resident_lock:
+        conversation = resident_messages['conversations'].get(get_conversation_key(user, other_user, group), [])
+        # One more message is taken to know if there is an older page
+        for message in reversed(conversation):
+            if before_id is not None and message['id'] >= before_id:
+                continue
+            if group is not None and user not in message['wrapped_keys']:
+                continue
+            messages.append(message)
+            if len(messages) > page_size:
+                break
+
+    cursor = None
+    if len(messages) > page_size:
+        messages = messages[:page_size]
+        cursor = messages[-1]['id']
+
+    messages.reverse()
+    return messages, cursor
+
+def get_public_user(user_data):
+    """
+    Give the part of a user record sent to the clients.
+
+    Args:
+        user_data (dict): The record of the user, or None.
+
+    Returns:
+        dict: The record without the password hash.
+        None: If user_data is None.
+    """
+    if user_data is None:
+        return None
+    return {field: user_data[field] for field in PUBLIC_USER_FIELDS if field in user_data}
+
+def check_message(message):
+    """
+    Check that a message sent by a client can be read by all its readers: its sender and recipient exist (or its group
+    exists and the sender is a member), and its session key is wrapped for each reader.
+
+    Args:
+        message (dict): The message.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If the message cannot be stored.
+    """
+    if not isinstance(message.get('cipher_body'), dict) or not isinstance(message.get('wrapped_keys'), dict):
+        raise ValueError("The message has no encrypted body or no wrapped session keys")
+    if find_user(message['sender']) is None:
+        raise ValueError(f"The user {message['sender']} does not exist")
+
+    if message.get('group') is not None:
+        group = find_group(message['group'])
+        if group is None or message['sender'] not in group['members']:
+            raise ValueError(f"{message['sender']} is not a member of the group {message['group']}")
+        readers = set(group['members'])
+        if set(message['wrapped_keys']) != readers:
+            raise ValueError(f"The session key is not wrapped for the members of the group {message['group']}")
+        return
+
+    if find_user(message['recipient']) is None:
+        raise ValueError(f"The user {message['recipient']} does not exist")
+    missing_readers = get_message_readers(message) - set(message['wrapped_keys'])
+    if missing_readers:
+        raise ValueError(f"The session key is not wrapped for {', '.join(sorted(missing_readers))}")
+
+def handle_server_request(request):
+    """
+    Answer a request sent to the server. It runs in a worker thread of the server: the writes still go one at a time
+    into the files, through the locks of the message log, the user directory and the groups.
+
+    Args:
+        request (dict): The request, with a "command" field:
+            - "get_user": the public record of "username" (None if it does not exist).
+            - "list_users": the public records of every user.
+            - "verify_password": tell if "password_hash" is the one of "username" (None if it does not exist).
+            - "create_user": store the record "user".
+            - "store_message": store the message "message" and index it.
+            - "fetch_page": a page of the conversation of "user" with "other_user" (or in "group") before "before_id".
+            - "get_summaries": the summaries of the conversations of "user".
+            - "get_group", "get_groups_of_user", "create_group": the groups.
+
+    Returns:
+        dict: The response, with an "ok" field (and an "error" field if it is False).
+
+    Raises:
+        ValueError, KeyError, TypeError: If the request is not valid (or a user or group already exists).
+    """
+    if not isinstance(request, dict):
+        raise TypeError("The request is not a JSON object")
+    command = request.get('command')
+
+    if command == "get_user":
+        return {"ok": True, "user": get_public_user(find_user(request['username']))}
+
+    if command == "list_users":
+        return {"ok": True, "users": [get_public_user(user) for user in get_user_directory()['users']]}
+
+    if command == "verify_password":
+        user_data = find_user(request['username'])
+        return {"ok": True, "valid": None if user_data is None else user_data['password'] == request['password_hash']}
+
+    if command == "create_user":
+        user_data = request['user']
+        add_user({field: user_data[field] for field in ("username", "password", "public_key", "key_version")})
+        return {"ok": True}
+
+    if command == "store_message":
+        message = {"id": None}
+        message.update({field: request['message'][field] for field in MESSAGE_FIELDS if field in request['message']})
+        check_message(message)
+        if not save_message(message):
+            return {"ok": False, "error": "Failed to write to file."}
+        return {"ok": True, "id": message['id']}
+
+    if command == "fetch_page":
+        messages, cursor = get_resident_page(
+            request['user'], request.get('other_user'), request.get('page_size', CONVERSATION_PAGE_SIZE),
+            request.get('before_id'), request.get('group')
+        )
+        return {"ok": True, "messages": messages, "cursor": cursor}
+
+    if command == "get_summaries":
+        return {"ok": True, "summaries": get_conversation_summaries(request['user'])}
+
+    if command == "get_group":
+        return {"ok": True, "group": find_group(request['name'])}
+
+    if command == "get_groups_of_user":
+        return {"ok": True, "groups": get_groups_of_user(request['user'])}
+
+    if command == "create_group":
+        return {"ok": True, "group": create_group(request['name'], request['members'], request['created_by'])}
+
+    return {"ok": False, "error": f"Unknown command {command}"}
+
+async def handle_server_client(reader, writer):
+    """
+    Answer the requests of a client, one JSON line each way, until it closes the connection.
+    The requests are answered in worker threads, so that the server keeps serving the other clients meanwhile.
+
+    Args:
+        reader (asyncio.StreamReader): The stream of the requests.
+        writer (asyncio.StreamWriter): The stream of the responses.
+
+    Returns:
+        None
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            # Every failed request is answered: a client without an answer would take the server for stopped
+            try:
+                response = await loop.run_in_executor(None, handle_server_request, json.loads(line))
+            except (ValueError, KeyError, TypeError) as error:
+                response = {"ok": False, "error": str(error)}
+            except Exception as error:
+                response = {"ok": False, "error": f"The server has failed to answer: {error!r}"}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        # Client gone, or a line longer than SERVER_LINE_LIMIT
+        pass
+    finally:
+        writer.close()
+
+async def serve_messages(address):
+    """
+    Listen on the address of the server until the server is stopped (SIGTERM).
+
+    Args:
+        address (str): The address of the server.
+
+    Returns:
+        None
+    """
+    family, socket_address = parse_server_address(address)
+
+    if family in (socket.AF_INET, socket.AF_INET6):
+        server = await asyncio.start_server(handle_server_client, *socket_address, limit=SERVER_LINE_LIMIT)
+    else:
+        # Only the current user can connect to the socket
+        previous_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(handle_server_client, socket_address, limit=SERVER_LINE_LIMIT)
+        finally:
+            os.umask(previous_umask)
+
+    stop_event = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    except (NotImplementedError, AttributeError):
+        # Windows: the server is stopped with CTRL + C
+        pass
+
+    print(f"Message server listening on {address}")
+    print(f"CIPHER_MESSAGING_SERVER={address}; export CIPHER_MESSAGING_SERVER;")
+
+    async with server:
+        await stop_event.wait()
+
+def run_message_server(address=SERVER_ADDRESS):
+    """
+    Run the message server in the foreground until it is interrupted (CTRL + C or SIGTERM).
+    It keeps the users and the messages in memory and stores what the clients send.
+
+    Args:
+        address (str): The address of the server. Defaults to SERVER_ADDRESS.
+
+    Returns:
+        None
+    """
+    try:
+        family, socket_address = parse_server_address(address)
+    except ValueError as error:
+        # The server has no authentication: it is never reachable from another machine
+        print(error)
+        return
+    tcp = family in (socket.AF_INET, socket.AF_INET6)
+    if family is None:
+        print("Unix sockets are not available on this platform, use a host:port address")
+        return
+    if not tcp and not create_private_socket_directory(socket_address):
+        print(f"The directory of {socket_address} is not private to the current user")
+        return
+
+    if send_server_request({"command": "list_users"}, address) is not None:
+        print(f"A message server is already running on {address}")
+        return
+    # Socket left by a server that has stopped (never one of another user)
+    if not tcp and not remove_stale_socket(socket_address):
+        print(f"{socket_address} belongs to another user")
+        return
+
+    # Loaded before the first client connects
+    get_user_directory()
+    refresh_resident_messages()
+
+    try:
+        asyncio.run(serve_messages(address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not tcp:
+            remove_stale_socket(socket_address)
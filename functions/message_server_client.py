@@ -0,0 +1,152 @@
+import ipaddress, json, os, socket, threading, time
+
+from functions.private_socket import PRIVATE_SOCKET_DIRECTORY, is_private_socket
+
+# Address of the message server (see message_server.py): the path of a Unix socket (by default in a directory only
+# accessible to the current user), or host:port for a TCP socket on a loopback address of this machine (where Unix
+# sockets are not available). Can be changed with the CIPHER_MESSAGING_SERVER environment variable.
+if hasattr(socket, "AF_UNIX"):
+    DEFAULT_SERVER_ADDRESS = os.path.join(PRIVATE_SOCKET_DIRECTORY, "server.sock")
+else:
+    DEFAULT_SERVER_ADDRESS = "127.0.0.1:7390"
+SERVER_ADDRESS = os.environ.get("CIPHER_MESSAGING_SERVER", DEFAULT_SERVER_ADDRESS)
+
+# Time (in seconds) a request waits for the response of the server
+SERVER_TIMEOUT = 30
+
+# Time (in seconds) during which the server is not tried again after a failed connection (the program then uses the files itself)
+SERVER_RETRY_INTERVAL = 5
+
+# Requests that change the files: once one has been sent, it is never sent again nor done by the program itself
+# (the server may have done it before its answer was lost)
+WRITE_COMMANDS = ("create_user", "store_message", "create_group")
+
+# Connection of this process to the server, kept between requests: {"socket": socket, "file": file, "failed_at": float}
+server_connection = {"socket": None, "file": None, "failed_at": None}
+server_connection_lock = threading.Lock()
+
+def parse_server_address(address):
+    """
+    Tell if a server address is a TCP address (host:port) or the path of a Unix socket.
+    The server has no authentication, so a TCP address must be a loopback address (only reachable from this machine).
+
+    Args:
+        address (str): The address of the server.
+
+    Returns:
+        tuple: (socket.AF_INET or socket.AF_INET6, (host, port)) for a TCP address, (socket.AF_UNIX, path) for a Unix socket.
+
+    Raises:
+        ValueError: If the host of a TCP address is not a loopback address.
+    """
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        return getattr(socket, "AF_UNIX", None), address
+
+    host = host.strip('[]')
+    if host == "localhost":
+        return socket.AF_INET, ("127.0.0.1", int(port))
+    try:
+        loopback = ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise ValueError(f"The message server can only listen on a loopback address, not on {host}")
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return family, (host, int(port))
+
+def close_server_connection():
+    """
+    Close the connection to the server, if there is one (the caller holds server_connection_lock).
+
+    Returns:
+        None
+    """
+    for name in ("file", "socket"):
+        if server_connection[name] is not None:
+            try:
+                server_connection[name].close()
+            except OSError:
+                pass
+            server_connection[name] = None
+
+def connect_to_server(address):
+    """
+    Open the connection to the server, unless the last try has failed a short time ago (the caller holds server_connection_lock).
+
+    Args:
+        address (str): The address of the server.
+
+    Returns:
+        bool: True if the connection is open.
+    """
+    failed_at = server_connection['failed_at']
+    if failed_at is not None and time.monotonic() - failed_at < SERVER_RETRY_INTERVAL:
+        return False
+
+    try:
+        family, socket_address = parse_server_address(address)
+    except ValueError:
+        family = None
+    # Requests are only sent to a socket of the current user: another user could answer them with their own public key
+    if family is None or (family == getattr(socket, "AF_UNIX", None) and not is_private_socket(socket_address)):
+        server_connection['failed_at'] = time.monotonic()
+        return False
+
+    server_socket = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        server_socket.settimeout(SERVER_TIMEOUT)
+        server_socket.connect(socket_address)
+    except OSError:
+        server_socket.close()
+        server_connection['failed_at'] = time.monotonic()
+        return False
+
+    server_connection.update({"socket": server_socket, "file": server_socket.makefile('rb'), "failed_at": None})
+    return True
+
+def send_server_request(request, address=SERVER_ADDRESS):
+    """
+    Send a request to the message server and wait for its response (one JSON line each way).
+    The connection is kept open for the next requests of the program.
+
+    Args:
+        request (dict): The request, with a "command" field.
+        address (str): The address of the server. Defaults to SERVER_ADDRESS.
+
+    Returns:
+        dict: The response of the server, with an "ok" field (and an "error" field if it is False, for example if it
+            has not answered in time, or if a request of WRITE_COMMANDS has been sent but not answered: the request may
+            still be done by the server, so it is not sent again).
+        None: If no server is running: the program then reads and writes the files itself.
+    """
+    with server_connection_lock:
+        # A kept connection may have been closed by a server that has restarted: the request is then sent again once,
+        # only if the server cannot have done it (sending failed, or a read request whose connection was closed without an answer)
+        for attempt in range(2):
+            reused = server_connection['socket'] is not None
+            if not reused and not connect_to_server(address):
+                return None
+
+            sent = False
+            try:
+                server_connection['socket'].sendall(json.dumps(request).encode() + b'\n')
+                sent = True
+                response = server_connection['file'].readline()
+            except socket.timeout:
+                close_server_connection()
+                return {"ok": False, "error": "The message server has not answered in time"}
+            except OSError:
+                response = None
+
+            if response:
+                return json.loads(response)
+
+            close_server_connection()
+            if sent and request.get('command') in WRITE_COMMANDS:
+                return {"ok": False, "error": "The message server has stopped before answering, the request may not have been done"}
+            if not reused:
+                server_connection['failed_at'] = time.monotonic()
+                return None
+
+        return None
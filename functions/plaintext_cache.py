@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+# Maximum number of decrypted messages kept in memory for the session
+PLAINTEXT_CACHE_SIZE = 1000
+
+# Decrypted messages of the session, by (message id, reader), least recently used first
+cached_plaintexts = OrderedDict()
+plaintext_lock = threading.Lock()
+
+def get_cached_plaintext(message_id, reader):
+    """
+    Retrieve the decrypted content of a message, if it has already been decrypted for this reader during the session.
+
+    Args:
+        message_id (int): The id of the message.
+        reader (str): The username of the reader.
+
+    Returns:
+        str: The decrypted message.
+        None: If it is not cached.
+    """
+    with plaintext_lock:
+        content = cached_plaintexts.get((message_id, reader))
+        if content is not None:
+            cached_plaintexts.move_to_end((message_id, reader))
+        return content
+
+def cache_plaintext(message_id, reader, content, max_size=PLAINTEXT_CACHE_SIZE):
+    """
+    Keep the decrypted content of a message for the session, dropping the least recently used ones beyond max_size.
+
+    Args:
+        message_id (int): The id of the message.
+        reader (str): The username of the reader.
+        content (str): The decrypted message.
+        max_size (int): The maximum number of cached messages. Defaults to PLAINTEXT_CACHE_SIZE.
+
+    Returns:
+        None
+    """
+    with plaintext_lock:
+        cached_plaintexts[(message_id, reader)] = content
+        cached_plaintexts.move_to_end((message_id, reader))
+        while len(cached_plaintexts) > max_size:
+            cached_plaintexts.popitem(last=False)
+
+def clear_plaintext_cache(reader=None):
+    """
+    Forget the decrypted messages of a reader (on logout), or of every reader.
+
+    Args:
+        reader (str): The username of the reader. Defaults to None (every reader).
+
+    Returns:
+        None
+    """
+    with plaintext_lock:
+        if reader is None:
+            cached_plaintexts.clear()
+            return
+        for key in [key for key in cached_plaintexts if key[1] == reader]:
+            del cached_plaintexts[key]
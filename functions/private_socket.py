@@ -0,0 +1,82 @@
+import getpass, os, stat, tempfile
+
+# Directory of the sockets of the key agent and of the message server, only accessible to the current user (like ssh-agent)
+PRIVATE_SOCKET_DIRECTORY = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+    f"cipher_messaging-{getpass.getuser()}"
+)
+
+def is_private_path(path, expected_type):
+    """
+    Check that a path is owned by the current user and gives no access to the other users.
+    The path itself is checked (a symbolic link is refused).
+
+    Args:
+        path (str): The path to check.
+        expected_type (function): The stat function telling the expected file type (stat.S_ISSOCK or stat.S_ISDIR).
+
+    Returns:
+        bool: True if the path can be trusted, False otherwise (or if it does not exist).
+    """
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return False
+
+    if not expected_type(path_stat.st_mode) or path_stat.st_mode & 0o077:
+        return False
+    # Windows has no user ids
+    return not hasattr(os, "getuid") or path_stat.st_uid == os.getuid()
+
+def is_private_socket(socket_path):
+    """
+    Check that a socket can be trusted before connecting to it: it must belong to the current user,
+    otherwise another user may have created it to receive the requests (and the keys sent with them).
+
+    Args:
+        socket_path (str): The path of the socket.
+
+    Returns:
+        bool: True if the socket can be trusted.
+    """
+    return is_private_path(socket_path, stat.S_ISSOCK)
+
+def create_private_socket_directory(socket_path):
+    """
+    Create the directory of a socket, only accessible to the current user, and check an existing one.
+
+    Args:
+        socket_path (str): The path of the socket.
+
+    Returns:
+        bool: True if the directory can be trusted, False if it belongs to another user or gives access to the other users.
+    """
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    if directory != PRIVATE_SOCKET_DIRECTORY:
+        # A directory chosen by the user (environment variable): the socket itself is only accessible to its owner
+        return os.path.isdir(directory)
+
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    return is_private_path(directory, stat.S_ISDIR)
+
+def remove_stale_socket(socket_path):
+    """
+    Remove a socket left by a program that has stopped, only if it belongs to the current user.
+
+    Args:
+        socket_path (str): The path of the socket.
+
+    Returns:
+        bool: True if there is no socket left at this path.
+    """
+    if not os.path.lexists(socket_path):
+        return True
+    if not is_private_socket(socket_path):
+        return False
+    os.remove(socket_path)
+    return True
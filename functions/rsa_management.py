@@ -1,43 +1,96 @@
-import random
+import base64, os, random, threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from functions.generate_prime_number import generatePrimeNumber, pgcd, modularInverse
+from functions.generate_prime_number import generatePrimeNumber, generatePrimeNumberWithSieve, pgcd, modularInverse
+from functions.key_agent_client import is_agent_key, agent_decrypt_integers
 
-def generate_rsa_keys(key_length=1024, seed=None, only_public_key=False, only_private_key=False):
+# Key formats, stored as "key_version" next to the public key in users.json.
+# Each version describes how the keys are derived from the seed, so a stored key can always be derived again.
+LEGACY_KEY_VERSION = 1      # random public exponent, users created before key versioning
+F4_KEY_VERSION = 2          # fixed public exponent 65537
+SIEVE_KEY_VERSION = 3       # fixed public exponent 65537, primes found by the sieve-based search
+MULTI_PRIME_KEY_VERSION = 4 # as SIEVE_KEY_VERSION, with a modulus of the same size made of three primes (opt-in)
+CURRENT_KEY_VERSION = SIEVE_KEY_VERSION
+
+KEY_PROFILES = {
+    LEGACY_KEY_VERSION: {"public_exponent": None, "prime_search": "random", "primes": 2},
+    F4_KEY_VERSION: {"public_exponent": 65537, "prime_search": "random", "primes": 2},
+    SIEVE_KEY_VERSION: {"public_exponent": 65537, "prime_search": "sieve", "primes": 2},
+    MULTI_PRIME_KEY_VERSION: {"public_exponent": 65537, "prime_search": "sieve", "primes": 3}
+}
+
+# With more than two primes, their two top bits do not guarantee a modulus of 2 * key_length bits (about 1 key in 40 is
+# one bit shorter with three primes): the primes are then drawn again from new seeds, at most this many times in all
+MULTI_PRIME_ATTEMPTS = 8
+
+# Message encodings produced by cipher_with_rsa
+LEGACY_MESSAGE_FORMAT = 1   # one ciphertext per character (list of integers)
+PACKED_MESSAGE_FORMAT = 2   # UTF-8 bytes padded and packed into modulus-sized blocks
+ENCODED_MESSAGE_FORMAT = 3  # blocks of one of the formats above, stored as fixed-width big-endian bytes in base64
+
+# Bytes taken by the padding of a packed block (0x00 0x02 + at least 8 random bytes + 0x00)
+PACKED_BLOCK_OVERHEAD = 11
+
+# The legacy format encrypts each character alone, so a character always gives the same ciphertext with a given key.
+# Codepoints and their ciphertexts are remembered per key (by modulus), for at most this many keys and characters per key.
+CODEPOINT_TABLE_KEYS = 16
+CODEPOINT_TABLE_SIZE = 1024
+
+# By modulus, least recently used first: {"public_exponent": int, "ciphertexts": OrderedDict (codepoint -> ciphertext), "codepoints": dict (ciphertext -> codepoint)}
+codepoint_tables = OrderedDict()
+codepoint_lock = threading.Lock()
+
+def generate_rsa_keys(key_length=1024, seed=None, only_public_key=False, only_private_key=False, crt_private_key=False, key_version=LEGACY_KEY_VERSION, parallel=True):
     """
     Asymetric Cryptography, generate a pair of keys (one public and private key for users)
     
     Args:
-        key_length (int): length of the keys
+        key_length (int): length of the keys (the modulus is twice as long)
+        crt_private_key (bool): return the private key in CRT form (p, q, dP, dQ, qInv) instead of (d, n)
+            (with a multi-prime profile: (p, q, dP, dQ, qInv, ((r, dR, tR), ...)))
+        key_version (int): the key profile to derive (see KEY_PROFILES), LEGACY_KEY_VERSION by default
+        parallel (bool): search the primes at the same time in worker processes
     Returns:
         str: giving the 2 keys (public key and private key)
     """
+    key_profile = KEY_PROFILES[key_version]
+    public_exponent = key_profile['public_exponent']
 
-    # Generation of 2 prime numbers with 2 different seeds
-    if seed is not None:
-        random.seed(seed)
-
-    seed_p = seed
-    seed_q = seed + "1" if seed is not None else None
-
-    p = generatePrimeNumber(key_length, seed=seed_p)
-    q = generatePrimeNumber(key_length, seed=seed_q)
+    # Generation of the prime numbers with different seeds ("seed", "seed1", "seed2"...), each one with its own random generator
+    prime_lengths = get_prime_lengths(key_length, key_profile)
+    for attempt in range(MULTI_PRIME_ATTEMPTS if key_profile['primes'] > 2 else 1):
+        seeds = get_prime_seeds(seed, key_profile['primes'], attempt)
+        primes = derive_primes(prime_lengths, seeds, key_profile, parallel=parallel)
+        product = 1
+        for prime, _ in primes:
+            product *= prime
+        if product.bit_length() == 2 * key_length:
+            break
+    p, q = primes[0][0], primes[1][0]
+    rng_q = primes[1][1]
+    other_primes = [prime for prime, _ in primes[2:]]
 
     # Define the module (n), and phi (Euler indicator function)
     n = p * q
     phi = (p - 1) * (q - 1)
+    for r in other_primes:
+        n *= r
+        phi *= r - 1
 
-    # Taking a public exponent (e must be prime with phi)
-    # We are doing this until we find a good random value
-    e = random.randrange(2, phi)
-    while pgcd(e, phi) != 1:
-        e = random.randrange(2, phi)
-
-    # Processing a private exponent
-    d = modularInverse(e, phi)
+    if public_exponent is not None:
+        e = public_exponent
+    else:
+        # Taking a public exponent (e must be prime with phi)
+        # We are doing this until we find a good random value (continuing the random stream of q)
+        e = rng_q.randrange(2, phi)
+        while pgcd(e, phi) != 1:
+            e = rng_q.randrange(2, phi)
 
     # Creating the two keys
     public_key = (e, n)
-    private_key = (d, n)
+    private_key = build_private_key(p, q, e, crt_private_key, other_primes)
 
     # Returning the keys
     if only_public_key:
@@ -47,34 +100,543 @@ def generate_rsa_keys(key_length=1024, seed=None, only_public_key=False, only_pr
     else:
         return public_key, private_key
     
-def cipher_with_rsa(message, public_key):
+def get_prime_seeds(seed, prime_count, attempt=0):
+    """
+    Give the seed of each prime of a key: the seed itself for the first one, then the seed followed by "1", "2"...
+    The primes of a multi-prime key drawn again (see MULTI_PRIME_ATTEMPTS) start from the seed followed by "/1", "/2"...
+
+    Args:
+        seed (str): the seed of the key (None for a random key)
+        prime_count (int): the number of primes of the key
+        attempt (int): the number of times the primes have already been drawn, 0 by default
+    Returns:
+        list: the seed of each prime
+    """
+    if seed is not None and attempt > 0:
+        seed = f"{seed}/{attempt}"
+    return [seed] + [seed + str(i) if seed is not None else None for i in range(1, prime_count)]
+
+def get_prime_lengths(key_length, key_profile):
+    """
+    Give the length of each prime of a key, so that the modulus is 2 * key_length bits long whatever the number of primes.
+
+    Args:
+        key_length (int): length of the keys
+        key_profile (dict): the key profile (see KEY_PROFILES)
+    Returns:
+        list: the length in bits of each prime
+    """
+    prime_count = key_profile['primes']
+    modulus_length = 2 * key_length
+    return [modulus_length // prime_count + (1 if i < modulus_length % prime_count else 0) for i in range(prime_count)]
+
+def build_private_key(p, q, e, crt_private_key=False, other_primes=()):
+    """
+    Build the private key matching two primes and a public exponent.
+
+    Args:
+        p (int): the first prime
+        q (int): the second prime
+        e (int): the public exponent
+        crt_private_key (bool): return the private key in CRT form (p, q, dP, dQ, qInv) instead of (d, n)
+        other_primes (list): the other primes of a multi-prime key, empty for a two-prime key
+    Returns:
+        tuple: the private key, in CRT form (p, q, dP, dQ, qInv, ((r, dR, tR), ...)) for a multi-prime key,
+            where tR is the inverse of the product of the primes before r, modulo r
+    """
+    # Processing a private exponent
+    n = p * q
+    phi = (p - 1) * (q - 1)
+    for r in other_primes:
+        n *= r
+        phi *= r - 1
+    d = modularInverse(e, phi)
+
+    if not crt_private_key:
+        return (d, n)
+    if not other_primes:
+        return (p, q, d % (p - 1), d % (q - 1), modularInverse(q, p))
+
+    other_prime_values = []
+    product = p * q
+    for r in other_primes:
+        other_prime_values.append((r, d % (r - 1), modularInverse(product % r, r)))
+        product *= r
+    return (p, q, d % (p - 1), d % (q - 1), modularInverse(q, p), tuple(other_prime_values))
+
+def recover_private_key(public_key, seed, key_length=1024, crt_private_key=False, key_version=LEGACY_KEY_VERSION):
+    """
+    Recover the private key matching a stored public key by deriving only p from the seed: q is n // p
+    and d is computed again from the stored public exponent. It gives the same key as generate_rsa_keys.
+    With a multi-prime profile, every prime but the last one is derived, and the last one is n divided by the others.
+
+    Args:
+        public_key (tuple): the stored RSA public key (e, n)
+        seed (str): the seed the keys were generated with
+        key_length (int): length of the keys
+        crt_private_key (bool): return the private key in CRT form (p, q, dP, dQ, qInv) instead of (d, n)
+        key_version (int): the key profile the keys were generated with (see KEY_PROFILES)
+    Returns:
+        tuple: the private key
+    Raises:
+        ValueError: if the primes derived from the seed do not divide the modulus (wrong seed or key version)
+    """
+    e, n = public_key
+    key_profile = KEY_PROFILES[key_version]
+    prime_count = key_profile['primes']
+
+    if prime_count == 2:
+        attempts = [[derive_prime(key_length, seed, key_profile)[0]]]
+    else:
+        # The primes may have been drawn again when the key was generated: the draws are tried in the same order
+        prime_lengths = get_prime_lengths(key_length, key_profile)[:-1]
+        attempts = (
+            [prime for prime, _ in derive_primes(prime_lengths, get_prime_seeds(seed, prime_count, attempt)[:-1], key_profile)]
+            for attempt in range(MULTI_PRIME_ATTEMPTS)
+        )
+
+    for primes in attempts:
+        product = 1
+        for prime in primes:
+            product *= prime
+        if n % product == 0:
+            primes.append(n // product)
+            return build_private_key(primes[0], primes[1], e, crt_private_key, primes[2:])
+
+    raise ValueError("The seed does not match the public key")
+
+def derive_prime(key_length, seed, key_profile):
+    """
+    Derive one of the primes of an RSA key from its seed, following a key profile.
+
+    Args:
+        key_length (int): length of the prime in bits
+        seed (str): the seed of the prime
+        key_profile (dict): the key profile (see KEY_PROFILES)
+    Returns:
+        int: the prime, such that p - 1 is prime with the public exponent of the profile (if it is fixed)
+        random.Random: the random generator of the search, in the state it was left in
+    """
+    public_exponent = key_profile['public_exponent']
+    rng = random.Random(seed)
+
+    if key_profile['prime_search'] == "sieve":
+        prime = generatePrimeNumberWithSieve(key_length, rng=rng)
+        attempt = 0
+        while public_exponent is not None and pgcd(public_exponent, prime - 1) != 1:
+            attempt += 1
+            rng = random.Random(f"{seed}#{attempt}" if seed is not None else None)
+            prime = generatePrimeNumberWithSieve(key_length, rng=rng)
+        return prime, rng
+
+    prime = generatePrimeNumber(key_length, rng=rng)
+    # With a fixed public exponent, p - 1 must be prime with it: continue with the same random stream
+    while public_exponent is not None and pgcd(public_exponent, prime - 1) != 1:
+        prime = generatePrimeNumber(key_length, rng=rng)
+    return prime, rng
+
+def derive_primes(key_lengths, seeds, key_profile, parallel=True):
+    """
+    Derive several primes of an RSA key, one per seed, in parallel worker processes if possible.
+
+    Args:
+        key_lengths (int or list): length of the primes in bits, or the length of each prime
+        seeds (list): the seed of each prime
+        key_profile (dict): the key profile (see KEY_PROFILES)
+        parallel (bool): search the primes at the same time in worker processes
+    Returns:
+        list: for each seed, a tuple (prime, random generator) as returned by derive_prime
+    """
+    if isinstance(key_lengths, int):
+        key_lengths = [key_lengths] * len(seeds)
+
+    if parallel and len(seeds) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=len(seeds)) as executor:
+                futures = [executor.submit(derive_prime, key_length, seed, key_profile) for key_length, seed in zip(key_lengths, seeds)]
+                return [future.result() for future in futures]
+        except (OSError, NotImplementedError, BrokenProcessPool):
+            # No worker processes available on this platform (or a worker has died): search one prime after the other
+            pass
+
+    return [derive_prime(key_length, seed, key_profile) for key_length, seed in zip(key_lengths, seeds)]
+
+def get_block_size(modulus):
+    """
+    Give the size in bytes of an RSA block for a given modulus.
+
+    Args:
+        modulus (int): The RSA modulus n.
+
+    Returns:
+        int: The number of bytes needed to write the modulus.
+    """
+    return (modulus.bit_length() + 7) // 8
+
+def get_modulus_from_private_key(private_key):
+    """
+    Give the RSA modulus of a private key.
+
+    Args:
+        private_key (tuple or dict): The RSA private key, either (d, n), the CRT form (p, q, dP, dQ, qInv)
+            (followed by ((r, dR, tR), ...) for a multi-prime key) or a key agent handle.
+
+    Returns:
+        int: The modulus n.
+    """
+    if is_agent_key(private_key):
+        return private_key['modulus']
+    if len(private_key) == 2:
+        return private_key[1]
+    modulus = private_key[0] * private_key[1]
+    if len(private_key) == 6:
+        for r, _, _ in private_key[5]:
+            modulus *= r
+    return modulus
+
+def pad_block(data, block_size):
+    """
+    Pad some bytes into a full RSA block (PKCS#1 v1.5 encryption padding).
+
+    Args:
+        data (bytes): The bytes to pad, at most block_size - PACKED_BLOCK_OVERHEAD long.
+        block_size (int): The size of the block in bytes.
+
+    Returns:
+        bytes: The padded block 0x00 0x02 || random non-zero bytes || 0x00 || data.
+    """
+    padding_length = block_size - 3 - len(data)
+    padding = bytes(byte for byte in os.urandom(2 * padding_length) if byte != 0)
+    while len(padding) < padding_length:
+        padding += bytes(byte for byte in os.urandom(padding_length) if byte != 0)
+    return b'\x00\x02' + padding[:padding_length] + b'\x00' + data
+
+def unpad_block(block):
+    """
+    Remove the padding added by pad_block.
+
+    Args:
+        block (bytes): The padded block.
+
+    Returns:
+        bytes: The data contained in the block.
+
+    Raises:
+        ValueError: If the block is not correctly padded.
+    """
+    separator = block.find(b'\x00', 2)
+    if block[:2] != b'\x00\x02' or separator < 10:
+        raise ValueError("Invalid padding in RSA block")
+    return block[separator + 1:]
+
+def cipher_bytes_with_rsa(data, public_key):
+    """
+    Encrypt some bytes using RSA encryption with a public key, packing them into padded blocks.
+
+    Args:
+        data (bytes): The bytes to encrypt.
+        public_key (tuple): The RSA public key (e, n).
+
+    Returns:
+        list: The encrypted blocks as a list of integers.
+    """
+    e, n = public_key
+    block_size = get_block_size(n)
+    chunk_size = block_size - PACKED_BLOCK_OVERHEAD
+
+    blocks = []
+    for i in range(0, max(len(data), 1), chunk_size):
+        padded_block = pad_block(data[i:i+chunk_size], block_size)
+        blocks.append(pow(int.from_bytes(padded_block, 'big'), e, n))
+
+    return blocks
+
+def encode_blocks(blocks, block_width=None, block_format=PACKED_MESSAGE_FORMAT, key_version=None):
+    """
+    Encode encrypted blocks for storage: each block is written as block_width big-endian bytes, and the whole in base64.
+    This is about 2.5 times smaller than a JSON list of decimal integers, and much faster to load.
+
+    Args:
+        blocks (list): The encrypted blocks as a list of integers.
+        block_width (int): The size of a block in bytes (get_block_size of the modulus). Defaults to the size of the biggest block.
+        block_format (int): The format of the blocks, PACKED_MESSAGE_FORMAT (default) or LEGACY_MESSAGE_FORMAT.
+        key_version (int): The version of the key the blocks are encrypted with, if it is known.
+
+    Returns:
+        dict: The encoded message {"format": ENCODED_MESSAGE_FORMAT, "block_format": int, "key_version": int,
+            "block_width": int, "blocks": str}.
+    """
+    if block_width is None:
+        block_width = max([(block.bit_length() + 7) // 8 for block in blocks] + [1])
+
+    data = b''.join(block.to_bytes(block_width, 'big') for block in blocks)
+    return {
+        "format": ENCODED_MESSAGE_FORMAT,
+        "block_format": block_format,
+        "key_version": key_version,
+        "block_width": block_width,
+        "blocks": base64.b64encode(data).decode('ascii')
+    }
+
+def decode_blocks(encrypted_message):
+    """
+    Give the encrypted blocks of a message, whatever the way it is stored.
+
+    Args:
+        encrypted_message (dict or list): The encrypted message, encoded (ENCODED_MESSAGE_FORMAT), packed
+            ({"format": PACKED_MESSAGE_FORMAT, "blocks": [...]}) or in the legacy format (a list of integers).
+
+    Returns:
+        list: The encrypted blocks as a list of integers.
+    """
+    if isinstance(encrypted_message, list):
+        return encrypted_message
+    if encrypted_message.get('format') != ENCODED_MESSAGE_FORMAT:
+        return encrypted_message['blocks']
+
+    data = base64.b64decode(encrypted_message['blocks'])
+    block_width = encrypted_message['block_width']
+    return [int.from_bytes(data[i:i+block_width], 'big') for i in range(0, len(data), block_width)]
+
+def get_block_format(encrypted_message):
+    """
+    Give the format of the blocks of an encrypted message.
+
+    Args:
+        encrypted_message (dict or list): The encrypted message, in any of the formats read by decode_blocks.
+
+    Returns:
+        int: PACKED_MESSAGE_FORMAT or LEGACY_MESSAGE_FORMAT.
+    """
+    if isinstance(encrypted_message, list):
+        return LEGACY_MESSAGE_FORMAT
+    if encrypted_message.get('format') == ENCODED_MESSAGE_FORMAT:
+        return encrypted_message['block_format']
+    return encrypted_message.get('format', LEGACY_MESSAGE_FORMAT)
+
+def get_codepoint_table(modulus, public_exponent=None):
+    """
+    Give the codepoint table of a key, creating it if needed (the caller holds codepoint_lock).
+
+    Args:
+        modulus (int): The RSA modulus n of the key.
+        public_exponent (int): The public exponent e, if it is known. A table filled with another exponent is emptied.
+
+    Returns:
+        dict: The table {"public_exponent": int, "ciphertexts": OrderedDict, "codepoints": dict}.
+    """
+    table = codepoint_tables.get(modulus)
+    if table is None or (public_exponent is not None and table['public_exponent'] not in (None, public_exponent)):
+        table = {"public_exponent": public_exponent, "ciphertexts": OrderedDict(), "codepoints": {}}
+        codepoint_tables[modulus] = table
+        while len(codepoint_tables) > CODEPOINT_TABLE_KEYS:
+            codepoint_tables.popitem(last=False)
+    elif public_exponent is not None:
+        table['public_exponent'] = public_exponent
+
+    codepoint_tables.move_to_end(modulus)
+    return table
+
+def remember_codepoint(table, codepoint, ciphertext):
+    """
+    Add a codepoint and its ciphertext to a codepoint table, dropping the least recently used one if it is full
+    (the caller holds codepoint_lock).
+
+    Args:
+        table (dict): The codepoint table of the key.
+        codepoint (int): The codepoint of the character.
+        ciphertext (int): Its ciphertext.
+
+    Returns:
+        None
+    """
+    table['ciphertexts'][codepoint] = ciphertext
+    table['codepoints'][ciphertext] = codepoint
+    while len(table['ciphertexts']) > CODEPOINT_TABLE_SIZE:
+        _, dropped_ciphertext = table['ciphertexts'].popitem(last=False)
+        table['codepoints'].pop(dropped_ciphertext, None)
+
+def cipher_codepoints_with_rsa(codepoints, public_key):
+    """
+    Encrypt characters one by one (legacy format), each distinct character being encrypted only once per key.
+
+    Args:
+        codepoints (list): The codepoints of the characters.
+        public_key (tuple): The RSA public key (e, n).
+
+    Returns:
+        list: The ciphertext of each character.
+    """
+    e, n = public_key
+    ciphertexts = []
+    with codepoint_lock:
+        table = get_codepoint_table(n, e)
+        for codepoint in codepoints:
+            ciphertext = table['ciphertexts'].get(codepoint)
+            if ciphertext is None:
+                ciphertext = pow(codepoint, e, n)
+                remember_codepoint(table, codepoint, ciphertext)
+            else:
+                table['ciphertexts'].move_to_end(codepoint)
+            ciphertexts.append(ciphertext)
+    return ciphertexts
+
+def decipher_codepoints_with_rsa(ciphertexts, private_key):
+    """
+    Decrypt characters encrypted one by one (legacy format). Ciphertexts already seen with this key are read
+    from its codepoint table, and each distinct new one is decrypted only once.
+
+    Args:
+        ciphertexts (list): The ciphertext of each character.
+        private_key (tuple or dict): The RSA private key, either (d, n), the CRT form (p, q, dP, dQ, qInv) or a key agent handle.
+
+    Returns:
+        list: The codepoint of each character.
+    """
+    n = get_modulus_from_private_key(private_key)
+
+    with codepoint_lock:
+        table = get_codepoint_table(n)
+        known_codepoints = {ciphertext: table['codepoints'].get(ciphertext) for ciphertext in ciphertexts}
+    unknown_ciphertexts = [ciphertext for ciphertext, codepoint in known_codepoints.items() if codepoint is None]
+
+    if unknown_ciphertexts:
+        decrypted_codepoints = decrypt_integers_with_rsa(unknown_ciphertexts, private_key)
+        known_codepoints.update(zip(unknown_ciphertexts, decrypted_codepoints))
+        with codepoint_lock:
+            table = get_codepoint_table(n)
+            for ciphertext, codepoint in zip(unknown_ciphertexts, decrypted_codepoints):
+                # Only real characters are remembered
+                if codepoint < 0x110000:
+                    remember_codepoint(table, codepoint, ciphertext)
+
+    with codepoint_lock:
+        table = get_codepoint_table(n)
+        for codepoint in set(known_codepoints.values()):
+            if codepoint in table['ciphertexts']:
+                table['ciphertexts'].move_to_end(codepoint)
+
+    return [known_codepoints[ciphertext] for ciphertext in ciphertexts]
+
+def clear_codepoint_tables():
+    """
+    Forget every codepoint table (on logout).
+
+    Returns:
+        None
+    """
+    with codepoint_lock:
+        codepoint_tables.clear()
+
+def cipher_with_rsa(message, public_key, message_format=PACKED_MESSAGE_FORMAT):
     """
     Encrypt a message using RSA encryption with a public key.
     
     Args:
         message (str): The message to encrypt.
         public_key (tuple): The RSA public key (e, n).
+        message_format (int): The encoding to produce, PACKED_MESSAGE_FORMAT (default), ENCODED_MESSAGE_FORMAT or LEGACY_MESSAGE_FORMAT.
     
     Returns:
-        list: The encrypted message as a list of integers.
+        dict: The encrypted message as {"format": PACKED_MESSAGE_FORMAT, "blocks": [int, ...]}.
+        dict: The packed blocks encoded by encode_blocks with ENCODED_MESSAGE_FORMAT.
+        list: The encrypted message as a list of integers (one per character) with LEGACY_MESSAGE_FORMAT.
     """
-    e, n = public_key
-    # Convert the message to a list of characters and encrypt each character
-    encrypted_message = [pow(ord(char), e, n) for char in message]
-    return encrypted_message
+    if message_format == LEGACY_MESSAGE_FORMAT:
+        # Convert the message to a list of characters and encrypt each character (each distinct one only once)
+        encrypted_message = cipher_codepoints_with_rsa([ord(char) for char in message], public_key)
+        return encrypted_message
+
+    # Pack the UTF-8 bytes of the message into as few blocks as possible
+    blocks = cipher_bytes_with_rsa(message.encode('utf-8'), public_key)
+    if message_format == ENCODED_MESSAGE_FORMAT:
+        return encode_blocks(blocks, get_block_size(public_key[1]))
+    return {"format": PACKED_MESSAGE_FORMAT, "blocks": blocks}
+
+def decrypt_integer_with_rsa(cipher_integer, private_key):
+    """
+    Decrypt a single RSA block with a private key.
+
+    Args:
+        cipher_integer (int): The encrypted block.
+        private_key (tuple): The RSA private key, either (d, n) or the CRT form (p, q, dP, dQ, qInv)
+            (followed by ((r, dR, tR), ...) for a multi-prime key).
+
+    Returns:
+        int: The decrypted block.
+    """
+    if len(private_key) == 2:
+        d, n = private_key
+        return pow(cipher_integer, d, n)
+
+    # CRT form: two half-size exponentiations recombined with Garner's formula
+    p, q, dP, dQ, qInv = private_key[:5]
+    m1 = pow(cipher_integer, dP, p)
+    m2 = pow(cipher_integer, dQ, q)
+    h = (qInv * (m1 - m2)) % p
+    m = m2 + h * q
+
+    if len(private_key) == 6:
+        # Multi-prime: one more small exponentiation per prime, added to the result the same way
+        product = p * q
+        for r, dR, tR in private_key[5]:
+            mR = pow(cipher_integer, dR, r)
+            h = (tR * (mR - m)) % r
+            m += h * product
+            product *= r
+
+    return m
+
+def decrypt_integers_with_rsa(cipher_integers, private_key):
+    """
+    Decrypt a list of RSA blocks with a private key.
+
+    Args:
+        cipher_integers (list): The encrypted blocks.
+        private_key (tuple or dict): The RSA private key, either (d, n), the CRT form (p, q, dP, dQ, qInv)
+            or a key agent handle (the blocks are then decrypted by the agent in one request).
+
+    Returns:
+        list: The decrypted blocks.
+    """
+    if is_agent_key(private_key):
+        return agent_decrypt_integers(private_key, cipher_integers)
+    return [decrypt_integer_with_rsa(cipher_integer, private_key) for cipher_integer in cipher_integers]
+
+def decipher_bytes_with_rsa(blocks, private_key):
+    """
+    Decrypt blocks produced by cipher_bytes_with_rsa.
+
+    Args:
+        blocks (list): The encrypted blocks as a list of integers.
+        private_key (tuple or dict): The RSA private key, either (d, n), the CRT form (p, q, dP, dQ, qInv) or a key agent handle.
+
+    Returns:
+        bytes: The decrypted bytes.
+    """
+    block_size = get_block_size(get_modulus_from_private_key(private_key))
+    return b''.join(
+        unpad_block(block.to_bytes(block_size, 'big'))
+        for block in decrypt_integers_with_rsa(blocks, private_key)
+    )
 
 def decipher_with_rsa(encrypted_message, private_key):
     """
     Decrypt a message using RSA encryption with a private key.
     
     Args:
-        encrypted_message (list): The encrypted message as a list of integers.
-        private_key (tuple): The RSA private key (d, n).
+        encrypted_message (dict or list): The encrypted message, either packed ({"format": ..., "blocks": [...]}),
+            encoded by encode_blocks or in the legacy format (a list of integers, one per character).
+        private_key (tuple or dict): The RSA private key, either (d, n), the CRT form (p, q, dP, dQ, qInv) or a key agent handle.
     
     Returns:
         str: The decrypted message.
     """
-    d, n = private_key
-    # Decrypt each character and convert back to string
-    decrypted_message = ''.join(chr(pow(char, d, n)) for char in encrypted_message)
+    blocks = decode_blocks(encrypted_message)
+
+    if get_block_format(encrypted_message) == PACKED_MESSAGE_FORMAT:
+        return decipher_bytes_with_rsa(blocks, private_key).decode('utf-8')
+
+    # Legacy format: decrypt each character (each distinct one only once) and convert back to string
+    decrypted_message = ''.join(chr(char) for char in decipher_codepoints_with_rsa(blocks, private_key))
     return decrypted_message
\ No newline at end of file
@@ -0,0 +1,100 @@
+import os
+
+from functions.hash_with_sha256 import sha256, Sha256
+
+# Size in bytes of the random session keys and nonces
+SESSION_KEY_LENGTH = 32
+NONCE_LENGTH = 16
+
+def generate_session_key():
+    """
+    Generate a random session key for the stream cipher.
+
+    Returns:
+        bytes: A random key of SESSION_KEY_LENGTH bytes.
+    """
+    return os.urandom(SESSION_KEY_LENGTH)
+
+def generate_keystream(session_key, nonce, length):
+    """
+    Generate a keystream by hashing the session key, the nonce and a block counter with SHA256.
+
+    Args:
+        session_key (bytes): The session key.
+        nonce (bytes): The nonce of the message.
+        length (int): The number of bytes needed.
+
+    Returns:
+        bytes: The keystream, 'length' bytes long.
+    """
+    # The key and the nonce are hashed only once, each block only adds its counter
+    prefix_hash = Sha256(session_key.hex() + nonce.hex())
+
+    keystream = b''
+    counter = 0
+    while len(keystream) < length:
+        block_hash = prefix_hash.copy()
+        block_hash.update(str(counter))
+        keystream += block_hash.digest()
+        counter += 1
+
+    return keystream[:length]
+
+def compute_tag(session_key, nonce, ciphertext):
+    """
+    Compute the integrity tag of an encrypted body.
+
+    Args:
+        session_key (bytes): The session key.
+        nonce (bytes): The nonce of the message.
+        ciphertext (bytes): The encrypted body.
+
+    Returns:
+        str: The tag as a hexadecimal string.
+    """
+    return sha256("tag" + session_key.hex() + nonce.hex() + ciphertext.hex())
+
+def cipher_with_stream(message, session_key):
+    """
+    Encrypt a message with the SHA256 keystream of a session key.
+
+    Args:
+        message (str): The message to encrypt.
+        session_key (bytes): The session key.
+
+    Returns:
+        dict: The encrypted body {"nonce": str, "ciphertext": str, "tag": str}, all hexadecimal strings.
+    """
+    nonce = os.urandom(NONCE_LENGTH)
+    data = message.encode('utf-8')
+    keystream = generate_keystream(session_key, nonce, len(data))
+    ciphertext = bytes(byte ^ key_byte for byte, key_byte in zip(data, keystream))
+
+    return {
+        "nonce": nonce.hex(),
+        "ciphertext": ciphertext.hex(),
+        "tag": compute_tag(session_key, nonce, ciphertext)
+    }
+
+def decipher_with_stream(encrypted_body, session_key):
+    """
+    Decrypt a body produced by cipher_with_stream.
+
+    Args:
+        encrypted_body (dict): The encrypted body {"nonce": str, "ciphertext": str, "tag": str}.
+        session_key (bytes): The session key.
+
+    Returns:
+        str: The decrypted message.
+
+    Raises:
+        ValueError: If the tag does not match (wrong key or altered body).
+    """
+    nonce = bytes.fromhex(encrypted_body['nonce'])
+    ciphertext = bytes.fromhex(encrypted_body['ciphertext'])
+
+    if compute_tag(session_key, nonce, ciphertext) != encrypted_body['tag']:
+        raise ValueError("Integrity check failed on the message body")
+
+    keystream = generate_keystream(session_key, nonce, len(ciphertext))
+    return bytes(byte ^ key_byte for byte, key_byte in zip(ciphertext, keystream)).decode('utf-8')
@@ -0,0 +1,137 @@
+import json, os, threading
+
+from functions.file_lock import file_lock, atomic_write
+
+USERS_FILENAME = 'data/users.json'
+
+# Loaded user files, by filename: {"signature": (inode, mtime, size), "users": list, "index": dict, "public_keys": dict}
+user_directories = {}
+directory_lock = threading.RLock()
+
+def get_file_signature(filename):
+    """
+    Give what identifies a version of a file: its inode (changed when the file is replaced), its modification time and its size.
+
+    Args:
+        filename (str): The path of the file.
+
+    Returns:
+        tuple: (inode, mtime in nanoseconds, size in bytes).
+        None: If the file does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def encode_username(username):
+    """
+    Give the name of the files of a user (key file, conversation index): the hexadecimal form of the username,
+    so that any username (with "/" or "..") stays one file name in the directory of these files.
+
+    Args:
+        username (str): The username.
+
+    Returns:
+        str: The encoded username.
+    """
+    return username.encode().hex()
+
+def get_user_directory(filename=USERS_FILENAME):
+    """
+    Give the user directory of a users file: the list of users and an index by username.
+    The file is only read again if it has changed (see get_file_signature).
+
+    Args:
+        filename (str): The path to the JSON file where user data is stored. Defaults to 'data/users.json'.
+
+    Returns:
+        dict: The directory {"signature": tuple, "users": list, "index": dict, "public_keys": dict}.
+
+    Raises:
+        json.JSONDecodeError: If the file is not valid JSON.
+    """
+    with directory_lock:
+        signature = get_file_signature(filename)
+        directory = user_directories.get(filename)
+
+        if directory is None or directory['signature'] != signature:
+            if signature is None:
+                users = []
+            else:
+                with open(filename, 'r') as file:
+                    users = json.load(file)
+            directory = {
+                "signature": signature,
+                "users": users,
+                "index": {user['username']: user for user in users},
+                "public_keys": {}
+            }
+            user_directories[filename] = directory
+
+        return directory
+
+def find_user(username, filename=USERS_FILENAME):
+    """
+    Find the record of a user.
+
+    Args:
+        username (str): The username.
+        filename (str): The path to the JSON file where user data is stored. Defaults to 'data/users.json'.
+
+    Returns:
+        dict: The record of the user.
+        None: If the user does not exist.
+    """
+    return get_user_directory(filename)['index'].get(username)
+
+def find_public_key(username, filename=USERS_FILENAME):
+    """
+    Find the public key of a user, parsed once and kept in the directory.
+
+    Args:
+        username (str): The username.
+        filename (str): The path to the JSON file where user data is stored. Defaults to 'data/users.json'.
+
+    Returns:
+        tuple: The RSA public key (e, n) of the user.
+        None: If the user does not exist.
+    """
+    with directory_lock:
+        directory = get_user_directory(filename)
+        public_key = directory['public_keys'].get(username)
+        if public_key is None:
+            user = directory['index'].get(username)
+            if user is None:
+                return None
+            public_key = tuple(user['public_key'])
+            directory['public_keys'][username] = public_key
+        return public_key
+
+def add_user(user_data, filename=USERS_FILENAME):
+    """
+    Add a user record to the users file and to the directory. The file is written to a temporary file and
+    replaced in one step, with a lock shared with the other programs using it, so that no user is lost.
+
+    Args:
+        user_data (dict): The record of the user.
+        filename (str): The path to the JSON file where user data is stored. Defaults to 'data/users.json'.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If a user with the same username already exists (created meanwhile by another program).
+    """
+    with file_lock(filename + ".lock", directory_lock):
+        # Read again if another program has changed the file
+        directory = get_user_directory(filename)
+        if user_data['username'] in directory['index']:
+            raise ValueError(f"The user {user_data['username']} already exists")
+
+        atomic_write(filename, json.dumps(directory['users'] + [user_data], indent=4))
+
+        directory['users'].append(user_data)
+        directory['index'][user_data['username']] = user_data
+        directory['signature'] = get_file_signature(filename)
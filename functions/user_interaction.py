@@ -1,8 +1,10 @@
 import os
 
-from functions.user_management import create_user, connexion_user, load_users, get_private_key_from_user
-from functions.conversation_management import load_conversations_from_user, send_message, load_conversation_between_two_users
-from functions.rsa_management import decipher_with_rsa
+from functions.user_management import create_user, connexion_user, load_users, get_private_key_from_user, wait_for_private_key
+from functions.key_cache import evict_private_key
+from functions.plaintext_cache import clear_plaintext_cache
+from functions.rsa_management import clear_codepoint_tables
+from functions.conversation_management import shutdown_decryption_pool, send_message, send_group_message, load_conversation_page, read_messages_for_user, load_conversation_summaries, load_group, load_groups_of_user, register_group
 from functions.colors import *
 from functions.clear_console import clear_console
 
@@ -56,7 +58,7 @@ def display_message_menu_in_console(user, password):
         user (str): The username of the connected user.
         password (str): The password of the connected user. (Note: Not used in the function directly, but may be required for future functionality.)
 
-    This function displays a menu with options for the connected user to either view their conversations or exit. It uses colored text for better visual appeal. Based on the user's choice, it either displays the user's conversations or returns to the connection menu.
+    This function displays a menu with options for the connected user to either view their conversations or exit. It uses colored text for better visual appeal. Based on the user's choice, it either displays the user's conversations or forgets the user's private key and decrypted messages and returns to the connection menu.
 
     Returns:
         None
@@ -77,21 +79,27 @@ def display_message_menu_in_console(user, password):
     if choice == "1":
         display_user_conversations(user, password)
     elif choice == "2":
+        evict_private_key(user)
+        clear_plaintext_cache(user)
+        clear_codepoint_tables()
+        shutdown_decryption_pool()
         display_connexion_menu_in_console()
     else:
         display_message_menu_in_console(user, password)
 
-def display_user_specific_conversation(user, other_user, conversation, password):
+def display_user_specific_conversation(user, other_user, conversation, password, cursor=None, group=None):
     """
-    Display a specific conversation between the user and another user, and handle message interactions.
+    Display a specific conversation between the user and another user (or a group), and handle message interactions.
 
     Args:
         user (str): The username of the connected user.
-        other_user (str): The username of the other participant in the conversation.
-        conversation (list): A list of messages exchanged between the user and the other user. Each message is a dictionary with details.
+        other_user (str): The username of the other participant in the conversation (None for a group).
+        conversation (list): The loaded messages exchanged between the user and the other user, oldest first. Each message is a dictionary with details.
         password (str): The password of the connected user, used to retrieve the user's private key.
+        cursor (int, optional): The cursor of the older messages not loaded yet (see load_conversation_page), None if every message is loaded.
+        group (str, optional): The name of the group, for a group conversation.
 
-    This function displays a formatted conversation between the connected user and another specified user. It includes a prompt for the user to enter their password to confirm access and displays each message with its timestamp and sender. After displaying the conversation, it offers options to send a new message or go back to the conversation list.
+    This function displays a formatted conversation between the connected user and another specified user. It uses the private key unlocked at login (a prompt for the user to enter their password to confirm access is only shown if it has expired) and displays each message with its timestamp and sender. Only the last messages are loaded when the conversation is opened. After displaying the conversation, it offers options to send a new message, load older messages or go back to the conversation list.
 
     Returns:
         None
@@ -113,40 +121,54 @@ def display_user_specific_conversation(user, other_user, conversation, password)
     print(f"{GREEN}{content_line}{RESET}")
     print(f"{GREEN}{bottom_line}{RESET}")
     print()
-    print(f"{GREEN}╔═══════════════════════════════════════════╗{RESET}")
-    print(f"{GREEN}║ {YELLOW}Please enter your password to confirm :{RESET}   {GREEN}║{RESET}")
-    print(f"{GREEN}╚═══════════════════════════════════════════╝{RESET}\n")
-    
-    user_private_key = get_private_key_from_user(user, password)
+    # The password is only asked again if the key of the session has expired
+    user_private_key = wait_for_private_key(user)
+    if user_private_key is None:
+        print(f"{GREEN}╔═══════════════════════════════════════════╗{RESET}")
+        print(f"{GREEN}║ {YELLOW}Please enter your password to confirm :{RESET}   {GREEN}║{RESET}")
+        print(f"{GREEN}╚═══════════════════════════════════════════╝{RESET}\n")
+
+        user_private_key = get_private_key_from_user(user, password)
+        if user_private_key is None:
+            input(f"{YELLOW}Press Enter to go back{RESET}")
+            display_user_conversations(user, password)
+            return
 
     print(f"{GREEN}╔═══════════════════════════════════════════╗{RESET}")
-    print(f"{GREEN}║ {CYAN}Conversation with {other_user}{RESET}                     {GREEN}║{RESET}")
+    if group is not None:
+        print(f"{GREEN}║ {CYAN}Group {group}{RESET}                     {GREEN}║{RESET}")
+    else:
+        print(f"{GREEN}║ {CYAN}Conversation with {other_user}{RESET}                     {GREEN}║{RESET}")
     print(f"{GREEN}╚═══════════════════════════════════════════╝{RESET}\n")
 
-    for message in conversation:
+    # The messages are decrypted in worker processes when there are many of them, and shown as soon as they are ready
+    contents = read_messages_for_user(messages=conversation, user=user, private_key=user_private_key)
+    for message, content in zip(conversation, contents):
         sender = message['sender']
         timestamp = message['timestamp']
-        if sender == user :
-            content = decipher_with_rsa(encrypted_message=message['cipher_message_for_sender'], private_key=user_private_key)
-        else:
-            content = decipher_with_rsa(encrypted_message=message['cipher_message_for_recipient'], private_key=user_private_key)
-        
+
         print(f"{YELLOW}[{timestamp}] {CYAN}{sender}:{RESET} {content}")
 
     print()
     print(f"{PURPLE}╔═══════════════════════════════════════════╗{RESET}")
     print(f"{PURPLE}║   {CYAN}1. {YELLOW}Send a message                       {PURPLE}║{RESET}")
     print(f"{PURPLE}║   {CYAN}2. {YELLOW}Go back                              {PURPLE}║{RESET}")
+    if cursor is not None:
+        print(f"{PURPLE}║   {CYAN}3. {YELLOW}Load older messages                  {PURPLE}║{RESET}")
     print(f"{PURPLE}╚═══════════════════════════════════════════╝{RESET}")
     print()
     choice = input("-> ")
 
     if choice == "1":
-        display_message_writing(user=user, other_user=other_user, conversation=conversation, password=password)
+        display_message_writing(user=user, other_user=other_user, conversation=conversation, password=password, group=group)
     elif choice == "2":
         display_user_conversations(user, password)
+    elif choice == "3" and cursor is not None:
+        older_messages, cursor = load_conversation_page(user=user, other_user=other_user, before_id=cursor, group=group)
+        clear_console()
+        display_user_specific_conversation(user, other_user, older_messages + conversation, password, cursor, group)
     else:
-        display_user_specific_conversation(user, other_user, conversation, password)
+        display_user_specific_conversation(user, other_user, conversation, password, cursor, group)
 
 def display_user_conversations(user, password):
     """
@@ -156,24 +178,31 @@ def display_user_conversations(user, password):
         user (str): The username of the connected user.
         password (str): The password of the connected user, used to retrieve the user's private key.
 
-    This function displays a list of conversations for the connected user, including an option to create a new conversation, open an existing conversation, or go back to the previous menu. It uses colored text for better visual appeal. The user is prompted to select an option, and the corresponding action is performed based on the choice.
+    This function displays a list of conversations for the connected user (from their conversation index, most recent first, groups next to conversations with one user), including an option to create a new conversation, create a group, open an existing conversation, or go back to the previous menu. It uses colored text for better visual appeal. The user is prompted to select an option, and the corresponding action is performed based on the choice.
 
     Returns:
         None
     """
     clear_console()
 
-    i = 1
-    conversations = load_conversations_from_user(user)
+    i = 2
+    summaries = load_conversation_summaries(user)
+    # Groups without any message yet are listed after the others
+    indexed_groups = [summary['group'] for summary in summaries if 'group' in summary]
+    summaries += [{"group": group['name']} for group in load_groups_of_user(user) if group['name'] not in indexed_groups]
 
     print(f"{GREEN}╔═══════════════════════════════════════╗{RESET}")
     print(f"{GREEN}║ {CYAN}Your conversations{RESET}                    {GREEN}║{RESET}")
     print(f"{GREEN}╚═══════════════════════════════════════╝{RESET}")
-    print(f"{GREEN}   {CYAN}{i}. {YELLOW}Create a conversation with another user{GREEN}  {RESET}")
+    print(f"{GREEN}   {CYAN}1. {YELLOW}Create a conversation with another user{GREEN}  {RESET}")
+    print(f"{GREEN}   {CYAN}2. {YELLOW}Create a group{GREEN}  {RESET}")
 
-    for other_user in conversations['users_interactions']:
+    for summary in summaries:
         i += 1
-        print(f"{GREEN}   {CYAN}{i}. {YELLOW}Open conversation with {other_user}")
+        if 'group' in summary:
+            print(f"{GREEN}   {CYAN}{i}. {YELLOW}Open group {summary['group']}")
+        else:
+            print(f"{GREEN}   {CYAN}{i}. {YELLOW}Open conversation with {summary['partner']}")
     print(f"{GREEN}   {CYAN}{i+1}. {YELLOW}Go back{RESET}")
     
     try:
@@ -184,17 +213,21 @@ def display_user_conversations(user, password):
     clear_console()
 
     if choice == 1:
-        display_message_writing(user=user, password=password, conversation=conversations)
+        display_message_writing(user=user, password=password, conversation=[])
+    elif choice == 2:
+        display_group_creation(user=user, password=password)
     elif choice == i+1:
         display_message_menu_in_console(user, password)
-    elif 1 < choice <= i:
-        other_user = conversations['users_interactions'][choice-2]
-        conversation = load_conversation_between_two_users(user=user, other_user=other_user)
-        display_user_specific_conversation(user=user, other_user=other_user, conversation=conversation, password=password)
+    elif 2 < choice <= i:
+        summary = summaries[choice-3]
+        group = summary.get('group')
+        other_user = summary.get('partner')
+        conversation, cursor = load_conversation_page(user=user, other_user=other_user, group=group)
+        display_user_specific_conversation(user=user, other_user=other_user, conversation=conversation, password=password, cursor=cursor, group=group)
     else : 
         display_user_conversations(user)
 
-def display_message_writing(user, conversation, password, other_user=None,):
+def display_message_writing(user, conversation, password, other_user=None, group=None):
     """
     Display a prompt to either create a conversation with another user or send a message in an existing conversation.
 
@@ -203,12 +236,23 @@ def display_message_writing(user, conversation, password, other_user=None,):
         conversation (list): The list of messages in the current conversation.
         password (str): The password of the connected user, used to retrieve the user's private key.
         other_user (str, optional): The username of the recipient for the message. If None, allows the user to select a recipient from available users.
+        group (str, optional): The name of the group the message is sent to (the body is then stored once for every member).
 
     This function allows the connected user to either select an existing user to start a new conversation or send a message to an existing conversation. If no recipient is specified (`other_user` is `None`), the function displays a list of available users to choose from. Once a recipient is selected or specified, the function prompts the user to enter a message and sends it.
 
     Returns:
         None
     """
+    if group is not None:
+        message = input(f"\n{YELLOW}What is the message that you want to send to the group {CYAN}{group}{YELLOW} ? {RESET}\n-> ")
+
+        send_group_message(user, group, message)
+        clear_console()
+        print(f"✅ {GREEN}Message has been sent")
+        conversation, cursor = load_conversation_page(user=user, other_user=None, group=group)
+        display_user_specific_conversation(user=user, other_user=None, conversation=conversation, password=password, cursor=cursor, group=group)
+        return
+
     if other_user is None:
         users = load_users()
         available_users = [u['username'] for u in users if u['username'] != user]
@@ -240,8 +284,71 @@ def display_message_writing(user, conversation, password, other_user=None,):
     send_message(user, other_user, message)
     clear_console()
     print(f"✅ {GREEN}Message has been sent")
-    conversation = load_conversation_between_two_users(user=user, other_user=other_user)
-    display_user_specific_conversation(user=user, other_user=other_user, conversation=conversation, password=password)
+    conversation, cursor = load_conversation_page(user=user, other_user=other_user)
+    display_user_specific_conversation(user=user, other_user=other_user, conversation=conversation, password=password, cursor=cursor)
 
     
-    
\ No newline at end of file
+    
+
+def group_name_input():
+    """
+    Prompt the user to enter the name of a new group until it is not empty and not taken.
+
+    Returns:
+        str: The name of the group.
+    """
+    group_name = input(f"{YELLOW}Enter the name of the group : {RESET}\n-> ").strip()
+    while not group_name or load_group(group_name) is not None:
+        print(f"{CYAN}This name is empty or already taken. Please choose another one.{RESET}")
+        group_name = input(f"{YELLOW}Enter the name of the group : {RESET}\n-> ").strip()
+    return group_name
+
+def display_group_creation(user, password):
+    """
+    Display a prompt to create a group with other users, then open the conversation of the new group.
+
+    Args:
+        user (str): The username of the connected user (the creator, and a member of the group).
+        password (str): The password of the connected user, used to retrieve the user's private key.
+
+    Returns:
+        None
+    """
+    available_users = [u['username'] for u in load_users() if u['username'] != user]
+    if not available_users:
+        print("No other users available for creating a group.")
+        display_user_conversations(user, password)
+        return
+
+    group_name = group_name_input()
+
+    print(f"{GREEN}╔═══════════════════════════════════════╗{RESET}")
+    print(f"{GREEN}║     {CYAN}Users available{RESET}                   {GREEN}║{RESET}")
+    print(f"{GREEN}╚═══════════════════════════════════════╝{RESET}\n")
+    for i, username in enumerate(available_users, start=1):
+        print(f"    {CYAN}{i}. {YELLOW}{username}{RESET}")
+
+    members = []
+    while not members:
+        try:
+            choices = input(f"\n{YELLOW}Enter the numbers of the members, separated by commas : {RESET}\n-> ")
+            numbers = [int(number) for number in choices.split(",") if number.strip()]
+            if numbers and all(1 <= number <= len(available_users) for number in numbers):
+                members = [available_users[number - 1] for number in numbers]
+            else:
+                print(f"{CYAN}Invalid choice. Please select valid numbers.{RESET}")
+        except ValueError:
+            print(f"{CYAN}Invalid input. Please enter numbers.{CYAN}")
+
+    # Another user may have created a group with the same name meanwhile: the name is asked again
+    while True:
+        try:
+            register_group(group_name, members, created_by=user)
+            break
+        except ValueError as error:
+            print(f"{CYAN}{error}. Please choose another name.{RESET}")
+        group_name = group_name_input()
+
+    clear_console()
+    print(f"✅ {GREEN}Group {group_name} has been created")
+    display_user_specific_conversation(user=user, other_user=None, conversation=[], password=password, group=group_name)
@@ -1,12 +1,27 @@
 import os, getpass, json, threading
+from concurrent.futures import Future, wait
 
 from functions.hash_with_sha256 import sha256
-from functions.rsa_management import generate_rsa_keys
+from functions.rsa_management import generate_rsa_keys, recover_private_key, CURRENT_KEY_VERSION, LEGACY_KEY_VERSION, KEY_PROFILES
 from functions.colors import *
 from functions.loading_message import display_loading_message
 from functions.clear_console import clear_console
-
-def load_users(filename='data/users.json'):
+from functions.user_directory import USERS_FILENAME, get_user_directory, find_user, find_public_key, add_user
+from functions.key_file import KEY_FILE_CACHE_ENABLED, load_key_file, store_key_file
+from functions.key_agent_client import agent_get_key, agent_add_key, agent_still_has_key, is_agent_key
+from functions.message_server_client import send_server_request
+from functions.key_cache import cache_private_key, get_cached_private_key, set_pending_private_key, get_pending_private_key, store_pending_private_key, evict_private_key
+
+# Opt-in: set the CIPHER_MESSAGING_KEY_VERSION environment variable to create the keys of new users with another profile
+# (for example 4 for three-prime keys). Existing users keep the version stored with their public key.
+try:
+    NEW_USER_KEY_VERSION = int(os.environ.get("CIPHER_MESSAGING_KEY_VERSION", CURRENT_KEY_VERSION))
+except ValueError:
+    NEW_USER_KEY_VERSION = CURRENT_KEY_VERSION
+if NEW_USER_KEY_VERSION not in KEY_PROFILES:
+    NEW_USER_KEY_VERSION = CURRENT_KEY_VERSION
+
+def load_users(filename=USERS_FILENAME):
     """
     Load a list of users from a JSON file.
 
@@ -18,66 +33,86 @@ def load_users(filename='data/users.json'):
 
     Notes:
         - If the JSON file does not exist, an empty list is returned.
-        - The function handles the FileNotFoundError to ensure that the application can continue to run even if the user file is missing.
+        - The list comes from the user directory, which only reads the file again when it has changed.
+        - If a message server is running, the list comes from it, and the records do not have the password hash.
     """
-    try:
-        with open(filename, 'r') as file:
-            users = json.load(file)
-    except FileNotFoundError:
-        users = []
-    return users
+    response = send_server_request({"command": "list_users"})
+    if response is not None and response['ok']:
+        return response['users']
+    return get_user_directory(filename)['users']
+
+def lookup_user(username, filename=USERS_FILENAME):
+    """
+    Find the record of a user, from the message server if one is running (the record then does not have the password hash).
+
+    Args:
+        username (str): The username.
+        filename (str): The path to the JSON file where user data is stored, without message server. Defaults to 'data/users.json'.
+
+    Returns:
+        dict: The record of the user.
+        None: If the user does not exist.
+    """
+    response = send_server_request({"command": "get_user", "username": username})
+    if response is not None and response['ok']:
+        return response['user']
+    return find_user(username, filename)
 
-def check_if_user_exists(username,users):
+def check_if_user_exists(username, filename=USERS_FILENAME):
     """
-    Check if a user with the given username exists in the list of users.
+    Check if a user with the given username exists, using the index of the user directory.
 
     Args:
         username (str): The username to check for existence.
-        users (list): A list of user records, where each record is a dictionary containing user details.
+        filename (str): The path to the JSON file where user data is stored. Defaults to 'data/users.json'.
 
     Returns:
-        bool: True if a user with the given username exists in the list, False otherwise.
+        bool: True if a user with the given username exists, False otherwise.
     """
-    for user in users:
-        if user['username'] == username :
-            return True
-    return False
+    return lookup_user(username, filename) is not None
             
 
 
-def store_user(username, password, public_key, users, filename='data/users.json'):
+def store_user(username, password, public_key, key_version=CURRENT_KEY_VERSION, filename=USERS_FILENAME):
     """
-    Store a user's username and hashed password in a JSON file.
+    Store a user's username and hashed password in a JSON file, through the message server if one is running.
     
     Args:
         username (str): The user's username.
         password (str): The user's password.
+        public_key (tuple): The user's RSA public key (e, n).
+        key_version (int): The key profile used to derive the user's keys. Defaults to CURRENT_KEY_VERSION.
         filename (str): The filename for the JSON file. Defaults to 'users.json'.
+
+    Raises:
+        ValueError: If a user with the same username already exists.
     """
     user_data = {
         "username": username,
         "password": password,
-        "public_key": public_key
+        "public_key": public_key,
+        "key_version": key_version
     }
 
-    users.append(user_data)
+    response = send_server_request({"command": "create_user", "user": user_data})
+    if response is not None:
+        if not response['ok']:
+            raise ValueError(response['error'])
+        return
 
-    with open(filename, 'w') as file:
-        json.dump(users, file, indent=4)
+    # Raises ValueError if another program has created the same username meanwhile
+    add_user(user_data, filename)
         
-def username_creation_input(users):
+def username_creation_input():
     """
-    Prompt the user to enter a username and check if it already exists in the list of users.
-
-    Args:
-        users (list): A list of user records, where each record is a dictionary containing user details.
+    Prompt the user to enter a username and check if it already exists.
 
     Returns:
-        str: The username entered by the user, if it does not already exist in the list.
+        str: The username entered by the user, if it does not already exist.
 
     Notes:
         - The function displays a prompt for the user to enter a username.
-        - It checks if the entered username already exists in the list of users using `check_if_user_exists`.
+        - It checks if the entered username already exists using `check_if_user_exists`.
         - If the username already exists, it informs the user and recursively prompts for a new username.
         - The process continues until a unique username is provided.
     """
@@ -86,9 +121,9 @@ def username_creation_input(users):
     print(f"{CYAN}╚═══════════════════════════════════════╝{RESET}")
     username = input("-> ")
 
-    if check_if_user_exists(username, users) == True:
+    if check_if_user_exists(username) == True:
         print("User already exists")
-        return username_creation_input(users)
+        return username_creation_input()
 
     return username
 
@@ -128,12 +163,12 @@ def create_user():
 
     Steps:
         1. Clears the console.
-        2. Loads the existing users from a JSON file.
-        3. Prompts the user to input a username, ensuring it does not already exist.
-        4. Prompts the user to create and confirm a password.
-        5. Starts a loading animation while generating RSA keys and hashing the password.
-        6. Stops the loading animation once the RSA keys are generated and the password is hashed.
-        7. Stores the user's information (username, hashed password, and public key) in the JSON file.
+        2. Prompts the user to input a username, ensuring it does not already exist.
+        3. Prompts the user to create and confirm a password.
+        4. Starts a loading animation while generating RSA keys and hashing the password.
+        5. Stops the loading animation once the RSA keys are generated and the password is hashed.
+        6. Stores the user's information (username, hashed password, and public key) in the JSON file.
+        7. Keeps the private key in the session key cache.
 
     Returns:
         tuple: A tuple containing:
@@ -143,23 +178,32 @@ def create_user():
     """
     clear_console()
 
-    users = load_users()
-
-    username = username_creation_input(users)
+    username = username_creation_input()
     clear_password = password_creation_input()
 
     loading_done_event = threading.Event()
     loading_thread = display_loading_message(loading_done_event)
 
-    public_key = generate_rsa_keys(seed=username+clear_password,only_public_key=True)
-    hash_password = sha256(clear_password)
-
-    loading_done_event.set()
-    loading_thread.join()
+    try:
+        public_key, private_key = generate_rsa_keys(seed=username+clear_password,crt_private_key=True,key_version=NEW_USER_KEY_VERSION)
+        hash_password = sha256(clear_password)
+    finally:
+        loading_done_event.set()
+        loading_thread.join()
 
     clear_console()
 
-    store_user(username, hash_password, public_key, users)
+    try:
+        store_user(username, hash_password, public_key, key_version=NEW_USER_KEY_VERSION)
+    except ValueError:
+        print("User already exists")
+        return create_user()
+
+    # The private key stays unlocked for the session (and in the key agent if one is running)
+    cache_private_key(username, private_key)
+    agent_add_key(username, private_key)
+    if KEY_FILE_CACHE_ENABLED:
+        store_key_file(username, clear_password, private_key)
 
     return True, username, clear_password
 
@@ -169,11 +213,11 @@ def connexion_user():
 
     Steps:
         1. Clears the console.
-        2. Loads existing users from a JSON file.
-        3. Prompts the user to enter their username.
-        4. Checks if the entered username exists. If not, informs the user and returns `False`.
-        5. If the username exists, repeatedly prompts for the password until the correct one is entered.
-        6. Verifies the password by comparing the hashed input with the stored hashed password.
+        2. Prompts the user to enter their username.
+        3. Checks if the entered username exists. If not, informs the user and returns `False`.
+        4. If the username exists, repeatedly prompts for the password until the correct one is entered.
+        5. Verifies the password by comparing the hashed input with the stored hashed password.
+        6. Starts unlocking the user's private key in the background, for the session key cache.
         7. Returns authentication status along with the username and password if successful.
 
     Returns:
@@ -184,14 +228,12 @@ def connexion_user():
     """
     clear_console()
 
-    users = load_users()
-
     print(f"{CYAN}╔═══════════════════════════════════════╗{RESET}")
     print(f"{CYAN}║       📝  {GREEN}Enter your username:        {CYAN}║{RESET}")
     print(f"{CYAN}╚═══════════════════════════════════════╝{RESET}")
     username = input("-> ")
 
-    if check_if_user_exists(username, users) == False:
+    if lookup_user(username) is None:
         print("This username does not exists, please create an account")
         return False, None, None
     else:
@@ -201,12 +243,11 @@ def connexion_user():
             print(f"{CYAN}║      🔐  {GREEN}Enter your password:{RESET}         {CYAN}║{RESET}")
             print(f"{CYAN}╚═══════════════════════════════════════╝{RESET}")
             password = getpass.getpass("-> ")
-            for user in users:
-                if user['username'] == username:
-                    if user['password'] == sha256(password):
-                        return True, username, password
-                    else :
-                        print("\nWrong password, please try again")
+            if verif_password(username, password):
+                prefetch_private_key(username, password)
+                return True, username, password
+            else :
+                print("\nWrong password, please try again")
 
 def verif_password(username, password):
     """
@@ -218,16 +259,21 @@ def verif_password(username, password):
 
     Returns:
         bool: True if the provided password matches the stored password for the username, False otherwise.
+        None: If the user does not exist.
+
+    Notes:
+        - If a message server is running, it compares the hashes (the clients do not get the stored hashes).
     """
-    users = load_users()
-    for user in users:
-        if user['username'] == username:
-            if user['password'] == sha256(password):
-                return True
-            else:
-                return False
+    response = send_server_request({"command": "verify_password", "username": username, "password_hash": sha256(password)})
+    if response is not None and response['ok']:
+        return response['valid']
+
+    user = find_user(username)
+    if user is None:
+        return None
+    return user['password'] == sha256(password)
             
-def get_public_key_from_user(user, filename='data/users.json'):
+def get_public_key_from_user(user, filename=USERS_FILENAME):
     """
     Retrieve the public key of a specific user from a JSON file.
     
@@ -236,19 +282,15 @@ def get_public_key_from_user(user, filename='data/users.json'):
         filename (str): The path to the JSON file containing user data. Defaults to 'data/users.json'.
     
     Returns:
-        list: The public key of the specified user.
+        tuple: The public key of the specified user.
         None: If the user is not found.
     """
-    try:
-        with open(filename, 'r') as file:
+    response = send_server_request({"command": "get_user", "username": user})
+    if response is not None and response['ok']:
+        return None if response['user'] is None else tuple(response['user']['public_key'])
 
-            users = json.load(file)
-            
-            for user_data in users:
-                if user_data['username'] == user:
-                    return user_data['public_key']
-            
-            return None
+    try:
+        return find_public_key(user, filename)
     
     except FileNotFoundError:
         print(f"File {filename} not found.")
@@ -258,17 +300,170 @@ def get_public_key_from_user(user, filename='data/users.json'):
         print("Error decoding JSON file.")
         return None
     
+def get_key_version_from_user(user, filename=USERS_FILENAME):
+    """
+    Retrieve the version of the key profile used to derive the keys of a specific user.
+
+    Args:
+        user (str): The username of the user.
+        filename (str): The path to the JSON file containing user data. Defaults to 'data/users.json'.
+
+    Returns:
+        int: The key version of the user. Users stored without a version use LEGACY_KEY_VERSION.
+    """
+    user_data = lookup_user(user, filename)
+    if user_data is None:
+        return LEGACY_KEY_VERSION
+    return user_data.get('key_version', LEGACY_KEY_VERSION)
+
+def derive_private_key(user, password):
+    """
+    Derive the private key of a user whose password has been verified, or get it from the key agent if it holds it
+    (or from the user's key file, if key files are enabled).
+
+    Args:
+        user (str): The username.
+        password (str): The verified password of the user.
+
+    Returns:
+        tuple: The RSA private key in CRT form (p, q, dP, dQ, qInv).
+        dict: A handle on the private key, if it is held by the key agent.
+    """
+    public_key = get_public_key_from_user(user)
+
+    # A running key agent may already hold the unlocked key (not an older or another key stored for the same username)
+    agent_key = agent_get_key(user)
+    if agent_key is not None and agent_key['modulus'] == public_key[1]:
+        return agent_key
+
+    # The password-wrapped key file (opt-in) avoids searching for primes
+    keys = load_key_file(user, password, public_key) if KEY_FILE_CACHE_ENABLED else None
+
+    if keys is None:
+        # Only p is derived from the seed, q comes from the public modulus
+        key_version = get_key_version_from_user(user)
+        keys = recover_private_key(public_key, seed=user+password, key_length=1024, crt_private_key=True, key_version=key_version)
+
+        # Missing or damaged key file: write it again
+        if KEY_FILE_CACHE_ENABLED:
+            store_key_file(user, password, keys)
+
+    # Give it to the key agent (if one is running) for the next sessions
+    agent_add_key(user, keys)
+
+    return keys
+
+def unlock_private_key(user, password):
+    """
+    Derive the private key of a user (whose password has been verified) and keep it in the session key cache.
+
+    Args:
+        user (str): The username.
+        password (str): The verified password of the user.
+
+    Returns:
+        tuple or dict: The RSA private key in CRT form (p, q, dP, dQ, qInv), or a handle on the key held by the key agent.
+        None: If the private key cannot be derived from the password (it does not match the stored public key).
+    """
+    loading_done_event = threading.Event()
+    loading_thread = display_loading_message(loading_done_event)
+
+    # The animation is stopped whatever happens, otherwise its thread keeps the program running
+    try:
+        keys = derive_private_key(user, password)
+    except ValueError:
+        keys = None
+    finally:
+        loading_done_event.set()
+        loading_thread.join()
+
+    if keys is None:
+        clear_console()
+        print(f"The private key of {user} cannot be derived from their password: it does not match their public key")
+        return None
+
+    cache_private_key(user, keys)
+
+    return keys
+
+def prefetch_private_key(user, password):
+    """
+    Start deriving the private key of a user (whose password has been verified) in the background.
+    The key goes into the session key cache as soon as it is ready.
+
+    Args:
+        user (str): The username.
+        password (str): The verified password of the user.
+
+    Returns:
+        concurrent.futures.Future: The future of the private key.
+    """
+    future = Future()
+
+    def derivation():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(derive_private_key(user, password))
+        except Exception as error:
+            future.set_exception(error)
+
+    set_pending_private_key(user, future)
+    threading.Thread(target=derivation, daemon=True).start()
+
+    return future
+
+def wait_for_private_key(user):
+    """
+    Return the private key of the user from the session key cache, waiting for the background derivation
+    if it has not finished yet. The loading animation is only displayed if the user actually has to wait.
+
+    Args:
+        user (str): The username.
+
+    Returns:
+        tuple or dict: The RSA private key of the user, or a handle on the key held by the key agent.
+        None: If the key is neither cached nor being derived (or its derivation failed).
+    """
+    future = get_pending_private_key(user)
+
+    if future is not None:
+        if not future.done():
+            loading_done_event = threading.Event()
+            loading_thread = display_loading_message(loading_done_event)
+            try:
+                wait([future])
+            finally:
+                loading_done_event.set()
+                loading_thread.join()
+        store_pending_private_key(user, future)
+
+    keys = get_cached_private_key(user)
+
+    # A key held by the agent may have expired there since it was cached
+    if keys is not None and is_agent_key(keys) and not agent_still_has_key(keys):
+        evict_private_key(user)
+        return None
+
+    return keys
+
 def get_private_key_from_user(user, password):
     """
-    Prompt the user to enter their password and verify it. If the password is correct, generate and return the private key.
+    Return the private key of the user from the session key cache. If it is not cached (or has expired),
+    prompt the user to enter their password and verify it. If the password is correct, generate and return the private key.
 
     Args:
         user (str): The username for which the private key is to be generated.
         password (str): The password used to verify the user's identity.
 
     Returns:
-        RSAKey: The generated RSA private key if the password is verified successfully.
+        tuple or dict: The RSA private key in CRT form (p, q, dP, dQ, qInv), or a handle on the key held by the key agent.
+        None: If the private key cannot be derived from the password (see unlock_private_key).
     """
+    keys = wait_for_private_key(user)
+    if keys is not None:
+        return keys
+
     verification_password = False
 
     while verification_password == False:
@@ -279,14 +474,4 @@ def get_private_key_from_user(user, password):
         else:
             print("Password inccorect, please try again...")
 
-    loading_done_event = threading.Event()
-    loading_thread = display_loading_message(loading_done_event)
-
-    keys = generate_rsa_keys(key_length=1024, seed=user+password, only_private_key=True)
-
-    loading_done_event.set()
-    loading_thread.join()
-
-    return keys
-
-
+    return unlock_private_key(user, password)
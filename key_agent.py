@@ -0,0 +1,5 @@
+from functions.key_agent import run_key_agent
+
+# Keeps the unlocked private keys in memory between two launches of main.py (like ssh-agent)
+if __name__ == "__main__":
+    run_key_agent()
@@ -1,4 +1,5 @@
 from functions.user_interaction import display_connexion_menu_in_console
 
-display_connexion_menu_in_console()
-
+# The guard keeps the worker processes used for key derivation from launching the menu again
+if __name__ == "__main__":
+    display_connexion_menu_in_console()
@@ -0,0 +1,5 @@
+from functions.message_server import run_message_server
+
+# Keeps the users and the messages in memory and stores what every launch of main.py sends (see the README)
+if __name__ == "__main__":
+    run_message_server()